@@ -0,0 +1,151 @@
+import numpy as np
+import pandas as pd
+
+from snapshots import EVENT_KINDS, TIME_BITS, SnapshotIndex, ranges
+
+# Activity timelines: every identification, comment, flag and vote, by the user who made it. The events are
+# snapshots.SnapshotIndex's event table (same extraction, same UTC times, events without a recorded user kept under
+# user -1) re-sorted once by (user, time). Each user's history is then one contiguous slice, found by a hash lookup
+# of the user, and counts over any time window are two binary searches, for one user or all of them at once.
+# Times are compared to the second throughout, as in snapshots.py: a bound inside a second counts from its start.
+#
+#   ACTIVITY = ActivityIndex.from_obs('observations/obs.json')       or ActivityIndex.from_snapshots(SNAPSHOTS)
+#   ACTIVITY.history(463097, start='2022-03-07', end='2022-03-14')       what they did that week
+#   ACTIVITY.rolling(window='7D', freq='D', users=[463097, 1442162], actions=['identification'])
+#   ACTIVITY.period_counts(freq='W')                                     events per user per week
+
+ACTIONS = EVENT_KINDS
+
+
+# (helper) Time -> whole seconds since 1970 (UTC); naive times are taken as UTC
+def to_seconds(t) -> int:
+    ts = pd.Timestamp(t)
+    if ts.tzinfo is None:
+        ts = ts.tz_localize('UTC')
+    return ts.value // 1_000_000_000
+
+
+class ActivityIndex:
+    def __init__(self, events: pd.DataFrame):
+        # events: user, observation, action, time (naive UTC) and own_observation, sorted by (user, time)
+        self.events = events
+        users = events['user'].to_numpy()
+        starts = np.flatnonzero(np.r_[True, users[1:] != users[:-1]]) if len(users) else np.zeros(0, dtype=np.int64)
+        # users in ID order, and where each one's history starts (offsets[i]:offsets[i + 1])
+        self.users = pd.Index(users[starts], name='user')
+        self.offsets = np.append(starts, len(users))
+        # whole seconds, computed as snapshots.py does
+        self.seconds = events['time'].to_numpy().astype('datetime64[s]').astype(np.int64)
+        # (user, second) pairs packed into one sortable int64, for searching every user's history at once
+        codes = np.repeat(np.arange(len(starts), dtype=np.int64), np.diff(self.offsets))
+        self.keys = (codes << TIME_BITS) | self.seconds
+        self.cumulative = {}
+
+    # observations: a condensed obs.json, or any iterable of condensed observations (e.g. an obsstore.ObsStore)
+    @classmethod
+    def from_obs(cls, observations='observations/obs.json'):
+        return cls.from_snapshots(SnapshotIndex.from_obs(observations))
+
+    # The same events as a snapshots.SnapshotIndex (built or loaded already), by user
+    @classmethod
+    def from_snapshots(cls, snapshots):
+        events = snapshots.events
+        observers = snapshots.observations['user'].to_numpy()[np.searchsorted(snapshots.obs_ids, events['observation'].to_numpy())]
+        users, seconds = events['user'].to_numpy(), events['seconds'].to_numpy()
+        # ties within a second keep the snapshot order (observation, then event ID)
+        order = np.lexsort((seconds, users))
+        events = pd.DataFrame(dict(user=users[order], observation=events['observation'].to_numpy()[order],
+                                   action=pd.Categorical.from_codes(events['kind'].cat.codes.to_numpy()[order], ACTIONS),
+                                   time=events['time'].to_numpy()[order], own_observation=(users == observers)[order]))
+        return cls(events)
+
+    def save(self, fname='observations/activity.pkl') -> None:
+        pd.to_pickle(self.events, fname)
+
+    @classmethod
+    def load(cls, fname='observations/activity.pkl'):
+        return cls(pd.read_pickle(fname))
+
+    def __len__(self):
+        return len(self.events)
+
+    # Users who identified someone else's observation, in ID order
+    def identifiers(self) -> pd.Index:
+        made = (self.events['action'] == 'identification').to_numpy() & ~self.events['own_observation'].to_numpy()
+        return pd.Index(np.unique(self.events['user'].to_numpy()[made]), name='user')
+
+    # (helper) position of each user's history, or -1 for users with none
+    def user_codes(self, users) -> np.ndarray:
+        return self.users.get_indexer(np.atleast_1d(users))
+
+    # One user's events, in time order, with start <= time < end (either may be None)
+    def history(self, user, start=None, end=None, actions=None) -> pd.DataFrame:
+        code = self.user_codes(user)[0]
+        if code < 0:
+            return self.events.iloc[:0]
+        lo, hi = self.offsets[code], self.offsets[code + 1]
+        seconds = self.seconds[lo:hi]
+        if start is not None:
+            lo += np.searchsorted(seconds, to_seconds(start), side='left')
+        if end is not None:
+            hi = self.offsets[code] + np.searchsorted(seconds, to_seconds(end), side='left')
+        events = self.events.iloc[lo:hi]
+        return events if actions is None else events[events['action'].isin(actions)]
+
+    # (helper) events of the given actions before each position (all actions if None), kept once computed
+    def counts_before(self, actions=None) -> np.ndarray:
+        key = None if actions is None else tuple(sorted(actions))
+        if key not in self.cumulative:
+            if key is None:
+                self.cumulative[key] = np.arange(len(self.events) + 1)
+            else:
+                chosen = self.events['action'].isin(key).to_numpy()
+                self.cumulative[key] = np.concatenate([[0], np.cumsum(chosen)])
+        return self.cumulative[key]
+
+    # (helper) positions of each (user code, second) in the sorted table: the first event at or after it
+    def positions(self, codes, seconds) -> np.ndarray:
+        return np.searchsorted(self.keys, (codes.astype(np.int64) << TIME_BITS) | seconds, side='left')
+
+    # Number of events by each user with start <= time < end, as a Series indexed by user (all users if None)
+    def counts_between(self, start, end, users=None, actions=None) -> pd.Series:
+        users = self.users if users is None else pd.Index(np.atleast_1d(users), name='user')
+        codes = self.user_codes(users)
+        found = codes >= 0
+        before = self.counts_before(actions)
+        lo = self.positions(codes[found], to_seconds(start))
+        hi = self.positions(codes[found], to_seconds(end))
+        counts = np.zeros(len(users), dtype=np.int64)
+        counts[found] = before[hi] - before[lo]
+        return pd.Series(counts, index=users, name='events')
+
+    # Events by each user in the `window` up to each time from start to end, every `freq`: users x times of
+    # counts over (t - window, t]. start and end default to the first and last event.
+    def rolling(self, window='7D', freq='D', users=None, start=None, end=None, actions=None) -> pd.DataFrame:
+        users = self.users if users is None else pd.Index(np.atleast_1d(users), name='user')
+        start = self.seconds.min() if start is None else to_seconds(start)
+        end = self.seconds.max() if end is None else to_seconds(end)
+        times = pd.date_range(pd.Timestamp(start, unit='s').normalize(), pd.Timestamp(end, unit='s'), freq=freq)
+        seconds = times.as_unit('s').asi8
+        window = pd.Timedelta(window) // pd.Timedelta(seconds=1)
+        codes = self.user_codes(users)
+        found = codes >= 0
+        before = self.counts_before(actions)
+        # (t - window, t] in whole seconds is [t - window + 1, t + 1)
+        hi = self.positions(codes[found, None], seconds[None, :] + 1)
+        lo = self.positions(codes[found, None], seconds[None, :] - window + 1)
+        counts = np.zeros((len(users), len(times)), dtype=np.int64)
+        counts[found] = before[hi] - before[lo]
+        return pd.DataFrame(counts, index=users, columns=pd.Index(times, name='time'))
+
+    # Events per user in each calendar period (a period alias, e.g. 'D', 'W', 'M'): a users x periods table of the non-empty ones
+    def period_counts(self, freq='W', users=None, actions=None) -> pd.DataFrame:
+        events = self.events
+        if users is not None:
+            codes = self.user_codes(users)
+            codes = codes[codes >= 0]
+            events = events.iloc[ranges(self.offsets[codes], self.offsets[codes + 1])]
+        if actions is not None:
+            events = events[events['action'].isin(actions)]
+        periods = events['time'].dt.to_period(freq)
+        return events.groupby([events['user'], periods.rename('period')]).size().unstack(fill_value=0)
@@ -0,0 +1,99 @@
+# Times and memory-profiles the pipeline stages on synthetic observations (synthetic.py) at increasing scales:
+#   python benchmarks/bench_pipeline.py --scales 10k,100k,1M --workers 4 --report reports/bench.json
+# Each scale runs in a scratch directory: generate the raw files of two harvests, prune each, merge them, export the
+# CSVs, then build stats and sessions from those, and the activity timelines. Timings, throughput and peak memory
+# per stage come from instrument.py, so two reports can be checked for regressions with `python cli.py compare OLD NEW`.
+# Raw files take about 16 KB per observation on disk, so 10M needs ~160 GB of scratch space.
+import argparse
+from importlib import import_module
+from os import chdir, getcwd, makedirs, rename
+from os.path import dirname, getsize, join
+from shutil import copy
+import sys
+from tempfile import TemporaryDirectory
+
+sys.path.insert(0, join(dirname(__file__), '..'))
+import instrument
+from instrument import count, instrumented
+from synthetic import TAXA_CSV, SyntheticObs, write_raw_folder
+
+
+def parse_scale(text) -> int:
+    multiplier = {'k': 1_000, 'm': 1_000_000}.get(text[-1].lower(), 1)
+    return int(float(text[:-1] if multiplier > 1 else text) * multiplier)
+
+
+@instrumented('generate')
+def generate(observations, harvests):
+    for folder, indices in harvests:
+        fnames = write_raw_folder(folder, map(observations.observation, indices))
+        count(records=len(indices), bytes_written=sum(getsize(fname) for fname in fnames))
+
+
+@instrumented('stats')
+def stats(process):
+    import pandas as pd
+    process.build_stats_table(pd.read_csv(process.LATEST_IDS_CSV))
+
+
+@instrumented('sessions')
+def sessions(process):
+    from loader import load_identifications
+    from sessions import build_sessions
+    ids = load_identifications(process.IDS_CSV)
+    build_sessions(ids)
+    count(records=len(ids))
+
+
+def run_scale(num_obs, workers, seed):
+    stage = import_module('import')
+    process = import_module('process')
+    observations = SyntheticObs(num_obs, seed)
+    harvests = [('raw/a', range(num_obs // 2)), ('raw/b', range(num_obs // 2, num_obs))]
+    generate(observations, harvests)
+    makedirs('obs')
+    for folder, _ in harvests:
+        stage.prune_obs_folder(folder, workers=workers)
+        rename(folder + '_condensed', 'obs/' + folder.split('/')[-1])
+    stage.merge_final()
+    process.export_all(src='Coccinellidae/obs.json')
+    stats(process)
+    sessions(process)
+    process.build_activity_index(src='Coccinellidae/obs.json', fname='activity.pkl')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scales', default='10k,100k', help="comma-separated observation counts, e.g. 10k,100k,1M,10M")
+    parser.add_argument('--workers', type=int, help="prune processes (default: one per core)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--report', help="write the per-stage results to this JSON file")
+    args = parser.parse_args()
+
+    home = getcwd()
+    results = []
+    for num_obs in map(parse_scale, args.scales.split(',')):
+        first = len(instrument.stages)
+        with TemporaryDirectory() as tmp:
+            chdir(tmp)
+            copy(TAXA_CSV, 'coccinellidae.csv')
+            try:
+                run_scale(num_obs, args.workers, args.seed)
+            finally:
+                chdir(home)
+        for report in instrument.stages[first:]:
+            report['scale'] = num_obs
+            results.append(report)
+
+    print(f"\n{'scale':>10} {'stage':<22} {'wall s':>9} {'cpu s':>9} {'peak MB':>9} {'records/s':>11}")
+    for report in results:
+        cpu = report['cpu_seconds'] + report['children_cpu_seconds']
+        peak = max(report['peak_rss_mb'], report['children_peak_rss_mb'] if report['children_cpu_seconds'] else 0)
+        print(f"{report['scale']:>10,} {report['stage']:<22} {report['wall_seconds']:>9.2f} {cpu:>9.2f} {peak:>9,.0f} "
+              f"{report['records_per_second'] or 0:>11,.0f}")
+    if args.report:
+        instrument.write_report(args.report)
+
+
+if __name__ == '__main__':
+    main()
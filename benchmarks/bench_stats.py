@@ -0,0 +1,97 @@
+# Times the vectorized build_stats_table against the original row-by-row version on synthetic identifications,
+# and checks that both produce the same table.
+#   python benchmarks/bench_stats.py --rows 1000000 --reference-rows 50000
+# (the row-by-row version takes over 20 minutes per million IDs, hence the separate --reference-rows)
+import argparse
+from os.path import dirname, join
+import sys
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, join(dirname(__file__), '..'))
+from process import build_stats_table
+
+
+# Power-law identifier activity (a handful of identifiers do most IDs, as in stats.csv),
+# with a few duplicate (identifier, observation) pairs and the odd subspecies/complex/form ID
+def synthetic_ids(num_rows, num_identifiers=12_000, seed=0):
+    rng = np.random.default_rng(seed)
+    identifier = rng.zipf(1.3, num_rows) % num_identifiers + 1
+    ranks = np.array(['species', 'genus', 'tribe', 'subfamily', 'family', 'subspecies', 'complex', 'form'])
+    rank = ranks[rng.choice(len(ranks), num_rows, p=[.80, .08, .06, .02, .03, .005, .0025, .0025])]
+    dates = pd.Timestamp('2015-01-01', tz='UTC') + pd.to_timedelta(rng.integers(0, 8 * 365 * 86400, num_rows), unit='s')
+    return pd.DataFrame(dict(observation=rng.integers(1, num_rows // 2, num_rows), identifier=identifier,
+                             username=['user' + str(i) for i in identifier], date=dates.strftime('%Y-%m-%dT%H:%M:%S+00:00'),
+                             rank=rank))
+
+
+# The original implementation: one .loc read-modify-write per ID, then a row-wise apply for the proportions
+def build_stats_table_rowwise(ids, identifier_stats):
+    def generate_stats(row):
+        rank = row['rank']
+        if rank not in identifier_stats.columns:
+            rank = 'species'
+        identifier = identifier_stats.loc[row['identifier']]
+        identifier['username'] = row['username']
+        identifier[rank] += 1
+        identifier['total'] += 1
+        identifier_stats.loc[row['identifier']] = identifier
+
+    def generate_proportions(row):
+        row['frac_species'] = row['species']/row['total']
+        row['frac_genus'] = row['genus']/row['total']
+        row['frac_tribe'] = row['tribe']/row['total']
+        row['frac_subfamily'] = row['subfamily']/row['total']
+        row['frac_family'] = row['family']/row['total']
+        return row
+
+    ids_nodup = ids.sort_values(by='date')
+    ids_nodup.drop_duplicates(subset=['identifier', 'observation'], keep='last', ignore_index=True, inplace=True)
+    ids_nodup.apply(generate_stats, axis='columns')
+    identifier_stats = identifier_stats.apply(generate_proportions, axis='columns')
+    identifier_stats.sort_values(by='total', ascending=False, inplace=True)
+    for col in ['total', 'species', 'genus', 'tribe', 'subfamily', 'family']:
+        identifier_stats[col] = identifier_stats[col].astype(int)
+    return identifier_stats
+
+
+def rowwise_stats(ids):
+    ids_nodup = ids.sort_values(by='date').drop_duplicates(subset=['identifier', 'observation'], keep='last')
+    identifier_ids = ids_nodup['identifier'].unique()
+    columns = ['total', 'frac_species', 'species', 'frac_genus', 'genus', 'frac_tribe', 'tribe', 'frac_subfamily', 'subfamily', 'frac_family', 'family']
+    identifier_stats = pd.DataFrame(np.zeros((len(identifier_ids), len(columns))), index=identifier_ids, columns=columns)
+    identifier_stats.insert(0, 'username', 'n/a')
+    return build_stats_table_rowwise(ids, identifier_stats)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--reference-rows', type=int, default=50_000, help="rows to run the row-by-row version on (0 to skip)")
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as tmp:
+        ids = synthetic_ids(args.rows)
+        start = perf_counter()
+        build_stats_table(ids, join(tmp, 'stats.csv'))
+        print(f"vectorized: {args.rows:,} IDs in {perf_counter() - start:.2f}s")
+
+        if args.reference_rows:
+            ids = ids.iloc[:args.reference_rows]
+            start = perf_counter()
+            new = build_stats_table(ids, join(tmp, 'stats.csv'))
+            new_time = perf_counter() - start
+            start = perf_counter()
+            old = rowwise_stats(ids)
+            old_time = perf_counter() - start
+            print(f"{args.reference_rows:,} IDs: vectorized {new_time:.2f}s, row-by-row {old_time:.2f}s ({old_time / new_time:.0f}x)")
+            # compare per identifier, since identifiers with equal totals may be listed in either order
+            pd.testing.assert_frame_equal(new.sort_index(), old.sort_index()[new.columns], check_names=False)
+            print("outputs match")
+
+
+if __name__ == '__main__':
+    main()
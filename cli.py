@@ -0,0 +1,220 @@
+import argparse
+from importlib import import_module
+
+# Command-line entry point for the pipeline stages:
+#   python cli.py fetch --filter taxon_id=48486 --filter place_id=66741
+#   python cli.py prune obs2
+#   python cli.py merge
+#   python cli.py ancestry --store observations
+#   python cli.py export --src observations
+#   python cli.py stats
+#   python cli.py profiles --top 50
+#   python cli.py activity --user 463097 --freq W
+#   python cli.py show 84868113 --store observations
+#   python cli.py --report reports/prune.json --profile prune_obs_folder prune obs2
+#   python cli.py compare reports/before.json reports/after.json
+# Each stage imports what it needs (import.py, process.py, pandas, ...) only once it runs, so --help and the
+# light stages start without loading the rest.
+
+DEFAULT_FILTERS = dict(created_d2="2022-03-31", taxon_id=48486, place_id=66741)
+
+
+# (helper) import.py can't be imported with an import statement, since its name is a keyword
+def import_stage():
+    return import_module('import')
+
+
+# (helper) 'key=value' -> (key, value), with numbers as ints
+def parse_filter(text):
+    key, sep, value = text.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError(f"expected KEY=VALUE, got '{text}'")
+    return key, int(value) if value.isdigit() else value
+
+
+def fetch(args):
+    stage = import_stage()
+    filters = dict(args.filter) if args.filter else DEFAULT_FILTERS
+    if args.shards:
+        stage.harvest_sharded(filters, num_shards=args.shards, fname_prefix=args.prefix,
+                              requests_per_minute=args.requests_per_minute, confirm=not args.yes)
+    else:
+        stage.import_obs(filters, start_from_id=args.start_from_id, fname_prefix=args.prefix, resume=not args.fresh,
+                         confirm=not args.yes, requests_per_minute=args.requests_per_minute)
+
+
+def sync(args):
+    import_stage().sync_obs(dict(args.filter) if args.filter else DEFAULT_FILTERS, store=args.store)
+    import_module('process').sync_derived(store=args.store, stats_fname=args.stats)
+
+
+def prune(args):
+    import_stage().prune_obs_folder(args.path, workers=args.workers)
+
+
+def merge(args):
+    import_stage().merge_final()
+
+
+def ancestry(args):
+    stage = import_stage()
+    if args.taxonomy_csv:
+        stage.write_taxonomy_csv(taxon_id=args.taxon_id, fname=args.taxonomy_csv)
+    else:
+        stage.import_ancestry(store=args.store)
+
+
+def export(args):
+    process = import_module('process')
+    if args.parquet:
+        process.export_parquet(src=args.src, dest=args.parquet)
+    else:
+        process.export_all(src=args.src + '/obs.json')
+
+
+def stats(args):
+    import pandas as pd
+    import_module('process').build_stats_table(pd.read_csv(args.ids), args.out)
+
+
+def profiles(args):
+    import pandas as pd
+    from loader import load_identifications
+    from profiles import IdentifierProfiles
+    user_totals = pd.read_csv(args.stats, index_col='identifier') if args.stats else None
+    profiles = IdentifierProfiles.from_ids(load_identifications(args.ids, index_col=0), user_totals=user_totals)
+    profiles.save(args.out)
+    print(profiles.proportions(profiles.top(args.top)).to_string())
+
+
+def activity(args):
+    from os.path import exists
+    if args.rebuild or not exists(args.out):
+        index = import_module('process').build_activity_index(src=args.src + '/obs.json', fname=args.out)
+    else:
+        from activity import ActivityIndex
+        index = ActivityIndex.load(args.out)
+    print(f"{len(index):,} events by {len(index.users):,} users")
+    if args.user:
+        print(index.period_counts(args.freq, users=[args.user]).T.to_string())
+
+
+def store(args):
+    from obsstore import build_store
+    print(build_store(args.src + '/obs.json'), "observations indexed")
+
+
+def show(args):
+    import json
+    from obsstore import ObsStore, STORE_NAME
+    store = ObsStore(f"{args.store}/{STORE_NAME}")
+    for obs_id in args.ids:
+        obs = store.get(obs_id)
+        print(json.dumps(obs, indent=2) if obs else f"Observation {obs_id} is not in '{args.store}'")
+
+
+def compare(args):
+    from instrument import compare
+    if compare(args.old, args.new, tolerance=args.tolerance):
+        raise SystemExit(1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Harvest and process iNaturalist identifications")
+    parser.add_argument('--offline', action='store_true', help="serve API calls only from the local response cache")
+    parser.add_argument('--api', metavar='URL', help="use another API root, e.g. a mock_server.py at http://localhost:8765/v1")
+    parser.add_argument('--traceback', action='store_true', help="show rich tracebacks (with locals) on errors")
+    parser.add_argument('--report', metavar='FNAME', help="write per-stage timings, throughput and memory to a JSON report")
+    parser.add_argument('--profile', metavar='STAGES', help="cProfile these stages (comma-separated, or 'all') into profiles/")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    cmd = commands.add_parser('fetch', help="download observations page by page (import_obs / harvest_sharded)")
+    cmd.add_argument('--filter', action='append', type=parse_filter, metavar='KEY=VALUE',
+                     help=f"API query filter, repeatable (default: {DEFAULT_FILTERS})")
+    cmd.add_argument('--start-from-id', type=int)
+    cmd.add_argument('--prefix', default='obs', help="output folder name")
+    cmd.add_argument('--shards', type=int, help="split the ID range across this many parallel workers")
+    cmd.add_argument('--fresh', action='store_true', help="start a new folder instead of resuming an unfinished one")
+    cmd.add_argument('--yes', action='store_true', help="don't ask for confirmation (before fetching, or before starting the shards)")
+    cmd.add_argument('--requests-per-minute', type=int, default=60)
+    cmd.set_defaults(run=fetch)
+
+    cmd = commands.add_parser('sync', help="fetch observations updated since the last sync and patch the derived tables")
+    cmd.add_argument('--filter', action='append', type=parse_filter, metavar='KEY=VALUE')
+    cmd.add_argument('--store', default='observations')
+    cmd.add_argument('--stats', default='stats.csv')
+    cmd.set_defaults(run=sync)
+
+    cmd = commands.add_parser('prune', help="prune a folder of raw pages into '<path>_condensed'")
+    cmd.add_argument('path')
+    cmd.add_argument('--workers', type=int, help="processes to prune with (default: one per core)")
+    cmd.set_defaults(run=prune)
+
+    cmd = commands.add_parser('merge', help="merge the condensed folders under obs/ into Coccinellidae/")
+    cmd.set_defaults(run=merge)
+
+    cmd = commands.add_parser('ancestry', help="fetch the ancestry of a condensed folder's taxa")
+    cmd.add_argument('--store', default='observations')
+    cmd.add_argument('--taxonomy-csv', metavar='FNAME', help="instead write the taxonomy table for --taxon-id")
+    cmd.add_argument('--taxon-id', type=int, default=48486)
+    cmd.set_defaults(run=ancestry)
+
+    cmd = commands.add_parser('export', help="write the identification/observation CSVs (or Parquet tables)")
+    cmd.add_argument('--src', default='observations', help="condensed folder to read")
+    cmd.add_argument('--parquet', metavar='DEST', help="write Parquet tables to DEST instead")
+    cmd.set_defaults(run=export)
+
+    cmd = commands.add_parser('stats', help="per-identifier rank counts (stats.csv)")
+    cmd.add_argument('--ids', default='identifications-latest.csv')
+    cmd.add_argument('--out', default='stats.csv')
+    cmd.set_defaults(run=stats)
+
+    cmd = commands.add_parser('profiles', help="count every identifier's IDs by category, rank, disagreement and year")
+    cmd.add_argument('--ids', default='identifications-coccinellidae.csv')
+    cmd.add_argument('--stats', default='stats.csv', help="leaderboard order (empty for ordering by the IDs counted)")
+    cmd.add_argument('--out', default='profiles.pkl')
+    cmd.add_argument('--top', type=int, default=20, help="print the shares of the top N identifiers")
+    cmd.set_defaults(run=profiles)
+
+    cmd = commands.add_parser('activity', help="every user's IDs, comments, flags and votes as one timeline")
+    cmd.add_argument('--src', default='observations')
+    cmd.add_argument('--out', default='observations/activity.pkl')
+    cmd.add_argument('--rebuild', action='store_true', help="rebuild the timeline even if it's been saved before")
+    cmd.add_argument('--user', type=int, help="print this user's activity per period")
+    cmd.add_argument('--freq', default='W', help="period for --user, e.g. D, W, M (default W)")
+    cmd.set_defaults(run=activity)
+
+    cmd = commands.add_parser('store', help="build the random-access store for an existing obs.json")
+    cmd.add_argument('--src', default='observations')
+    cmd.set_defaults(run=store)
+
+    cmd = commands.add_parser('show', help="print observations by ID from the random-access store")
+    cmd.add_argument('ids', type=int, nargs='+')
+    cmd.add_argument('--store', default='observations')
+    cmd.set_defaults(run=show)
+
+    cmd = commands.add_parser('compare', help="compare two run reports; exits 1 if any stage regressed")
+    cmd.add_argument('old')
+    cmd.add_argument('new')
+    cmd.add_argument('--tolerance', type=float, default=0.2, help="allowed slowdown/memory growth (default 0.2 = 20%%)")
+    cmd.set_defaults(run=compare)
+
+    args = parser.parse_args(argv)
+    if args.traceback:
+        from rich.traceback import install
+        install(show_locals=True)
+    if args.report or args.profile:
+        import instrument
+        if args.report:
+            instrument.report_to(args.report)
+        if args.profile:
+            instrument.settings['profile'] = set(args.profile.split(','))
+    if args.offline or args.api:
+        import inat_cache
+        inat_cache.set_offline(args.offline)
+        inat_cache.use_api(args.api)
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,31 @@
 import csv
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timezone
 from glob import glob
 import json
 from math import ceil
-from os import mkdir
-from os.path import exists, basename
+from os import mkdir, remove, rename, replace
+from os.path import exists, basename, getsize
+from queue import Full, Queue
+from shutil import rmtree
+from threading import Lock, Thread
+from time import monotonic, sleep
 
-from pyinaturalist import get_observations, get_taxa, get_taxa_by_id
+from inat_cache import get_observations, get_taxa, get_taxa_by_id
 from rich import print
 from rich.prompt import Confirm
 
+from instrument import count, instrumented
+from jsonstream import JsonArrayWriter, iter_json_array, merge_sorted, read_small, write_small
+from obsstore import STORE_NAME, StoreWriter, user_key_files
+
 # Main process:
 # 1.  import_obs() 
 # 2.  prune_obs_folder() to reduce file size and reclaim disk space by eliminating redundant data
 # 3.  repeat 1 & 2 as needed until out of pages to fetch
 # 4.  merge_final() to combine into the three final collections
 # 5.  import_ancestry()
+# Afterwards, sync_obs() then process.sync_derived() refresh everything from just the observations updated since the last sync
 
 def jload(fname):
     with open(fname) as f:
@@ -26,67 +37,311 @@ def jwrite(data, fname) -> None:
         json.dump(data, f, indent=2, default=str)
 
 
-# Fetches observations from API and writes them to disk as JSON files in 20k-obs increments
-def import_obs(filters=dict(created_d2="2022-03-31", taxon_id=48486, place_id=66741), start_from_id=None, fname_prefix='obs'):
-    OBS_PER_PAGE = 200
-    PAGES_PER_FILE = 100
+OBS_PER_PAGE = 200
+PAGES_PER_FILE = 100
+REQUESTS_PER_MINUTE = 60     # iNat API budget: ~1 request/sec
+QUEUE_PAGES = 20             # fetched pages allowed to wait on the writer before fetching blocks
+CHECKPOINT = '.checkpoint'   # cursor file kept in each output folder (not *.json, so prune skips it)
 
-    if exists(fname_prefix):
-        n = 2
-        while exists(fname_prefix + str(n)):
-            n += 1
-        fname_prefix += str(n)
-    mkdir(fname_prefix)
-    fname_prefix = fname_prefix + "/" + fname_prefix
-    
+
+# (helper) Token bucket limiter: wait() blocks until another request fits within the API budget
+class RateLimiter:
+    def __init__(self, per_minute=REQUESTS_PER_MINUTE, burst=1):
+        self.rate = per_minute / 60
+        self.capacity = burst
+        self.tokens = burst
+        self.last = monotonic()
+        self.lock = Lock()
+
+    def wait(self) -> None:
+        with self.lock:
+            while True:
+                now = monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                sleep((1 - self.tokens) / self.rate)
+
+
+# (helper) Writer stage: serializes pages as they arrive, rolls a new file every PAGES_PER_FILE pages,
+# and checkpoints the id_above cursor after every page so an interrupted run can pick up where it left off
+def write_pages(pages: Queue, folder, ckpt) -> None:
+    def part_name(file=None):
+        return f"{folder}/{basename(folder)}_{file or ckpt['file']}.json"
+
+    # (helper) Finishes the current file: the checkpoint moves on to the next file before the .part is renamed,
+    # so a crash in between leaves a complete .part behind (renamed on resume), never a checkpoint into a missing file
+    def finish_file():
+        writer.close()
+        fname = part_name()
+        ckpt.update(file=ckpt['file'] + 1, pages=0, offset=0)
+        write_small(ckpt, f"{folder}/{CHECKPOINT}")
+        rename(fname + '.part', fname)
+        print(f"Saved '{fname}'")
+        count(bytes_written=getsize(fname))
+
+    if ckpt['file'] > 1 and exists(part_name(ckpt['file'] - 1) + '.part'):
+        rename(part_name(ckpt['file'] - 1) + '.part', part_name(ckpt['file'] - 1))
+        print(f"Saved '{part_name(ckpt['file'] - 1)}' (left unrenamed by the interrupted run)")
+    writer = JsonArrayWriter(part_name() + '.part', offset=ckpt['offset'])
+    while True:
+        results, finished = pages.get()
+        if results is None:
+            break
+        for obs in results:
+            writer.write(obs)
+            ckpt['first_id'] = ckpt['first_id'] or obs['id']
+        writer.flush()
+        if results:
+            ckpt['last_id'] = results[-1]['id']
+            ckpt['count'] += len(results)
+            ckpt['pages'] += 1
+            count(records=len(results), pages=1)
+        ckpt['offset'] = writer.offset
+        if ckpt['pages'] >= PAGES_PER_FILE:
+            finish_file()
+            writer = JsonArrayWriter(part_name() + '.part')
+        write_small(ckpt, f"{folder}/{CHECKPOINT}")
+
+    # Close out whatever is left in the current file
+    if ckpt['pages']:
+        finish_file()
+    else:
+        writer.close()
+        remove(part_name() + '.part')
+    ckpt['done'] = finished
+    write_small(ckpt, f"{folder}/{CHECKPOINT}")
+
+
+# Fetches observations from API and writes them to disk as JSON files in 20k-obs increments.
+# Fetching and writing run as two overlapped stages; if the output folder holds an unfinished
+# checkpoint (i.e. a crashed or interrupted run), it resumes from that run's last saved ID.
+# Returns the name of the folder the observations were saved in.
+@instrumented()
+def import_obs(filters=dict(created_d2="2022-03-31", taxon_id=48486, place_id=66741), start_from_id=None, fname_prefix='obs',
+               resume=True, confirm=True, requests_per_minute=REQUESTS_PER_MINUTE):
+    ckpt = read_small(f"{fname_prefix}/{CHECKPOINT}")
+    if resume and ckpt and not ckpt['done']:
+        print(f"Resuming '{fname_prefix}' after ID {ckpt['last_id']} ({ckpt['count']} observations already saved)")
+        filters = ckpt['filters']
+        start_from_id = ckpt['last_id'] or ckpt['start_from_id']
+    else:
+        if exists(fname_prefix):
+            n = 2
+            while exists(fname_prefix + str(n)):
+                n += 1
+            fname_prefix += str(n)
+        mkdir(fname_prefix)
+        ckpt = dict(filters=filters, start_from_id=start_from_id, file=1, pages=0, offset=0,
+                    first_id=None, last_id=None, count=0, done=False)
+        write_small(ckpt, f"{fname_prefix}/{CHECKPOINT}")
+
+    limiter = RateLimiter(requests_per_minute)
+    def fetch(id_above):
+        limiter.wait()
+        return get_observations(**filters, verifiable=True, per_page=OBS_PER_PAGE, order_by='id', order='asc', id_above=id_above)
+
+    # put() with a timeout, so a crashed writer can't leave the fetcher blocked on a full queue
+    pages = Queue(maxsize=QUEUE_PAGES)
+    def enqueue(item):
+        while True:
+            if not writer.is_alive():
+                raise RuntimeError("Writer stage stopped unexpectedly")
+            try:
+                pages.put(item, timeout=1)
+                return
+            except Full:
+                pass
+
+    writer = Thread(target=write_pages, args=(pages, fname_prefix, ckpt), daemon=True)
+    writer.start()
+    finished = declined = False
     try:
         pgcount = 1
         print(f"Requesting page {pgcount}...", end=" ")
-        page = get_observations(**filters, verifiable=True, per_page=OBS_PER_PAGE, order_by='id', order='asc', id_above=start_from_id)
-        obs = page['results']
-        print(f"First {len(obs)} observations retrieved, checking total...")
+        page = fetch(start_from_id)
+        enqueue((page['results'], False))
+        print(f"First {len(page['results'])} observations retrieved, checking total...")
 
         num_requests = ceil(page['total_results']/OBS_PER_PAGE)
-        if num_requests > 1:
+        if num_requests > 1 and confirm:
             print(f"Fetching all {page['total_results']} results will require {num_requests} API requests;", end=" ")
             if not Confirm.ask("continue?"):
                 page['total_results'] = 0
-        
+                declined = True
+
         while page['total_results'] > OBS_PER_PAGE:
             pgcount += 1
             last_id = page['results'][-1]['id']
             print(f"Requesting page {pgcount} (IDs after {last_id})...", end=" ")
-            page = get_observations(**filters, verifiable=True, per_page=OBS_PER_PAGE, order_by='id', order='asc', id_above=last_id)
+            page = fetch(last_id)
             print(f"{len(page['results'])} observations retrieved")
-            obs.extend(page['results'])
-            # Write to file and free up memory space every 100 pages
-            if pgcount % PAGES_PER_FILE == 0:
-                fname = f"{fname_prefix}_{pgcount // PAGES_PER_FILE}.json"
-                print(f"Saving progress as '{fname}'...")
-                with open(fname, 'w') as f:
-                    json.dump(obs, f, indent=2, default=str)
-                del obs
-                obs = []
+            enqueue((page['results'], False))
+        finished = not declined
 
     except KeyboardInterrupt:
         print("\nExiting...", end="")
     finally:
-        fname = f"{fname_prefix}_{ceil(pgcount / PAGES_PER_FILE)}.json"
-        with open(fname, 'w') as f:
-            json.dump(obs, f, indent=2, default=str)
-        print(f"\n{len(obs)} observations saved as '{fname}'")
+        # Let the writer drain what's already been fetched, then close the last file
+        if writer.is_alive():
+            pages.put((None, finished))
+            writer.join()
+        print(f"\n{ckpt['count']} observations saved in '{fname_prefix}' (last ID {ckpt['last_id']})")
+    return fname_prefix
+
+
+# (helper) Number of verifiable observations matching filters, without fetching any of them
+def count_obs(filters, **bounds) -> int:
+    return get_observations(**filters, **bounds, verifiable=True, per_page=0)['total_results']
+
+
+# Probes the ID distribution of a query and splits it into num_shards contiguous, roughly equal-count
+# ID ranges. Each shard is a dict of (id_above, id_below) bounds, both exclusive; the last shard is
+# left open-ended so observations uploaded after the probe still land somewhere.
+def plan_shards(filters, num_shards, samples_per_shard=4, requests_per_minute=REQUESTS_PER_MINUTE):
+    limiter = RateLimiter(requests_per_minute)
+    def probe(**params):
+        limiter.wait()
+        return get_observations(**filters, **params, verifiable=True)
+
+    first = probe(per_page=1, order_by='id', order='asc')
+    last = probe(per_page=1, order_by='id', order='desc')
+    total = first['total_results']
+    if total == 0:
+        return []
+    lo, hi = first['results'][0]['id'], last['results'][0]['id']
+
+    # Sample the cumulative count (observations with ID <= x) at evenly spaced IDs, then
+    # interpolate where each equal-count boundary falls
+    num_samples = num_shards * samples_per_shard
+    xs = [lo - 1] + [lo + (hi - lo) * k // num_samples for k in range(1, num_samples)] + [hi]
+    cumulative = [0]
+    for x in xs[1:-1]:
+        limiter.wait()
+        cumulative.append(count_obs(filters, id_below=x + 1))
+    cumulative.append(total)
+
+    bounds = [lo - 1]
+    k = 1
+    for s in range(1, num_shards):
+        target = total * s / num_shards
+        while cumulative[k] < target:
+            k += 1
+        span = cumulative[k] - cumulative[k-1]
+        x = xs[k-1] + (xs[k] - xs[k-1]) * (target - cumulative[k-1]) / span
+        bounds.append(max(int(x), bounds[-1] + 1))
+    bounds.append(None)
+
+    shards = []
+    for id_above, upper in zip(bounds, bounds[1:]):
+        id_below = upper + 1 if upper is not None else None
+        limiter.wait()
+        expected = count_obs(filters, id_above=id_above, **({'id_below': id_below} if id_below else {}))
+        shards.append(dict(id_above=id_above, id_below=id_below, expected=expected))
+    return shards
+
+
+# Harvests one query as num_shards disjoint ID ranges, each imported by its own worker process into
+# its own obsN/ folder with its own checkpoint. The plan is saved as '<prefix>_shards.json', so
+# re-running with the same prefix resumes unfinished shards instead of re-probing.
+# The API budget is shared between workers; they still finish sooner because each one overlaps
+# its request latency with the others'. With confirm=False it starts the shards without asking.
+@instrumented()
+def harvest_sharded(filters=dict(created_d2="2022-03-31", taxon_id=48486, place_id=66741), num_shards=4, fname_prefix='obs',
+                    requests_per_minute=REQUESTS_PER_MINUTE, confirm=True):
+    plan_fname = f"{fname_prefix}_shards.json"
+    plan = read_small(plan_fname)
+    if plan is None:
+        print(f"Probing ID distribution for {num_shards} shards...")
+        shards = plan_shards(filters, num_shards, requests_per_minute=requests_per_minute)
+        n = 1
+        for shard in shards:
+            while exists(fname_prefix + str(n)):
+                n += 1
+            shard['folder'] = fname_prefix + str(n)
+            n += 1
+        plan = dict(filters=filters, shards=shards)
+        write_small(plan, plan_fname)
+    filters = plan['filters']
+
+    todo = []
+    for shard in plan['shards']:
+        ckpt = read_small(f"{shard['folder']}/{CHECKPOINT}")
+        if ckpt and ckpt['done']:
+            continue
+        print(f"Shard '{shard['folder']}': IDs after {shard['id_above']}" + (f" and below {shard['id_below']}" if shard['id_below'] else "") + f" (~{shard['expected']} observations)")
+        todo.append(shard)
+    if todo and confirm and not Confirm.ask(f"Harvest {len(todo)} shards?"):
+        return plan
+
+    per_worker = requests_per_minute / max(len(todo), 1)
+    with ProcessPoolExecutor(max_workers=max(len(todo), 1)) as pool:
+        jobs = []
+        for shard in todo:
+            shard_filters = {**filters, 'id_below': shard['id_below']} if shard['id_below'] else filters
+            jobs.append(pool.submit(import_obs, shard_filters, start_from_id=shard['id_above'], fname_prefix=shard['folder'],
+                                    confirm=False, requests_per_minute=per_worker))
+        for job in jobs:
+            job.result()
+
+    check_shards(plan_fname)
+    return plan
+
+
+# Checks that the shards in a plan tile the ID space: every shard finished, each one's saved IDs stay
+# inside its own bounds, consecutive shards neither overlap nor leave a gap, and counts match the probe
+# (except the open-ended last shard's, which grows as new observations are uploaded).
+# Returns a list of problems (empty if the harvest is complete).
+def check_shards(plan_fname='obs_shards.json'):
+    plan = read_small(plan_fname)
+    problems = []
+    prev = None
+    for shard in plan['shards']:
+        name = shard['folder']
+        ckpt = read_small(f"{name}/{CHECKPOINT}")
+        if ckpt is None:
+            problems.append(f"'{name}' has not been started")
+        elif not ckpt['done']:
+            problems.append(f"'{name}' is unfinished (stopped after ID {ckpt['last_id']})")
+        elif ckpt['count']:
+            if ckpt['first_id'] <= shard['id_above'] or (shard['id_below'] and ckpt['last_id'] >= shard['id_below']):
+                problems.append(f"'{name}' holds IDs {ckpt['first_id']}-{ckpt['last_id']}, outside its bounds")
+            if shard['id_below'] and ckpt['count'] != shard['expected']:
+                problems.append(f"'{name}' saved {ckpt['count']} observations, probe expected {shard['expected']}")
+        if prev is not None:
+            if prev['id_below'] is None or prev['id_below'] - 1 < shard['id_above']:
+                problems.append(f"Gap between '{prev['folder']}' and '{name}'")
+            elif prev['id_below'] - 1 > shard['id_above']:
+                problems.append(f"'{prev['folder']}' and '{name}' overlap")
+        prev = shard
+
+    if problems:
+        print(f"[red]{len(problems)} problem(s) with '{plan_fname}':[/red]")
+        for problem in problems:
+            print(" -", problem)
+    else:
+        print(f"All {len(plan['shards'])} shards complete and contiguous")
+    return problems
+
 
 
+TAXON_FIELDS = 'id, current_synonymous_taxon_ids, ancestor_ids, name, preferred_common_name, rank, rank_level, atlas_id, endemic, threatened, native, introduced, is_active, created_at, observations_count, complete_species_count'
+
+# (helper) The fields of a taxon worth keeping
+def taxon_record(orig) -> dict:
+    new_taxon = {}
+    for field in TAXON_FIELDS.split(", "):
+        if field in orig:
+            new_taxon[field] = orig[field]
+    return new_taxon
+
 
 # (helper) Adds to the ongoing list, and returns a minimum stub for the parent data object
 def prune_taxon(orig, taxon_key):
     if orig['id'] not in taxon_key:
-        taxon_fields = 'id, current_synonymous_taxon_ids, ancestor_ids, name, preferred_common_name, rank, rank_level, atlas_id, endemic, threatened, native, introduced, is_active, created_at, observations_count, complete_species_count'
-        new_taxon = {}
-        for field in taxon_fields.split(", "):
-            if field in orig:
-                new_taxon[field] = orig[field]
-        taxon_key[orig['id']] = new_taxon
+        taxon_key[orig['id']] = taxon_record(orig)
     return dict(id=orig['id'], name=orig['name'], rank=orig['rank'], rank_level=orig['rank_level'], observations_count=orig['observations_count'])
 
 
@@ -110,68 +365,88 @@ def drop_fields(doc: dict, fields: str, hard_prune_user=True) -> dict:
     return doc
 
 
+# (helper) Drops irrelevant fields from one raw observation and splits off its users and taxa into the given keys
+def prune_obs(obs, identifier_key, observer_key, taxon_key) -> dict:
+    # Just save number of photos, for now
+    obs['num_photos'] = len(obs['photos'])
+    # Drop irrelevant fields
+    obs = drop_fields(obs, 'uuid, photos, captive, sounds, faves, faves_count, time_zone_offset, observed_on_string, observed_on_details, observed_time_zone, created_time_zone, uri, observation_photos, oauth_application_id, observed_on_details, created_at_details, non_owner_ids, location, project_ids, project_ids_with_curator_id, project_ids_without_curator_id, project_observations, ident_taxon_ids, identifications_count, comments_count, id_please, site_id, preferences, outlinks, license_code, spam', hard_prune_user=False)
+    observer_key[obs['user']['id']] = obs['user']
+    obs['user'] = drop_fields(obs['user'], '')
+    # Group geospatial fields
+    geospatial_fields = 'geojson, positional_accuracy, public_positional_accuracy, obscured, geoprivacy, taxon_geoprivacy, context_user_geoprivacy, place_ids, place_guess, mappable, map_scale'
+    obs['geospatial'] = {}
+    for field in geospatial_fields.split(", "):
+        if field in obs:
+            obs['geospatial'][field] = obs[field]
+            del obs[field]
+    # Taxon
+    obs['taxon'] = prune_taxon(obs['taxon'], taxon_key)
+    # Identifications: trim info, replace user and taxon objects
+    for ident in obs['identifications']:
+        if not ident['own_observation']:
+            ident = drop_fields(ident, 'uuid, own_observation, created_at_details', hard_prune_user=False)
+            identifier_key[ident['user']['id']] = ident['user']
+            ident['user'] = drop_fields(ident['user'], '')
+        else:
+            ident = drop_fields(ident, 'uuid, own_observation, created_at_details')
+        ident['taxon'] = prune_taxon(ident['taxon'], taxon_key)
+        if 'previous_observation_taxon' in ident:
+            ident['previous_observation_taxon'] = prune_taxon(ident['previous_observation_taxon'], taxon_key)
+    # Comments
+    for com in obs['comments']:
+        com = drop_fields(com, 'uuid, id, login, moderator_actions, flags, created_at_details, previous_observation_taxon_id')
+    # Annotations
+    for an in obs['annotations']:
+        an = drop_fields(an, 'uuid, controlled_value_id, controlled_attribute_id, vote_score')
+        an['votes'] = drop_fields(an['votes'], '')
+    # Flags
+    for flag in obs['flags']:
+        flag = drop_fields(flag, '')
+    # Ofvs
+    for obs_field in obs['ofvs']:
+        obs_field = drop_fields(obs_field, 'id, uuid, name_ci, value_ci')
+        if 'taxon' in obs_field:
+            obs_field['taxon'] = obs_field['taxon']['id']
+    # Votes
+    for vote in obs['votes']:
+        vote = drop_fields(vote, 'id')
+    # Quality metrics
+    for metric in obs['quality_metrics']:
+        metric = drop_fields(metric, 'user_id, id')
+    return obs
+
+
 # (helper) Drops irrelevant fields and splits off users and taxa into separate collections for less duplication
+@instrumented()
 def prune_file(fname):
     print(f"Loading '{basename(fname)}'")
-    observations = jload(fname)
-    print("Processing...")
-
     identifier_key = {}
     observer_key = {}
     taxon_key = {}
-    for obs in observations:
-        # Just save number of photos, for now
-        obs['num_photos'] = len(obs['photos'])
-        # Drop irrelevant fields
-        obs = drop_fields(obs, 'uuid, photos, captive, sounds, faves, faves_count, time_zone_offset, observed_on_string, observed_on_details, observed_time_zone, created_time_zone, uri, observation_photos, oauth_application_id, observed_on_details, created_at_details, non_owner_ids, location, project_ids, project_ids_with_curator_id, project_ids_without_curator_id, project_observations, ident_taxon_ids, identifications_count, comments_count, id_please, site_id, preferences, outlinks, license_code, spam', hard_prune_user=False)
-        observer_key[obs['user']['id']] = obs['user']
-        obs['user'] = drop_fields(obs['user'], '')
-        # Group geospatial fields
-        geospatial_fields = 'geojson, positional_accuracy, public_positional_accuracy, obscured, geoprivacy, taxon_geoprivacy, context_user_geoprivacy, place_ids, place_guess, mappable, map_scale'
-        obs['geospatial'] = {}
-        for field in geospatial_fields.split(", "):
-            if field in obs:
-                obs['geospatial'][field] = obs[field]
-                del obs[field]
-        # Taxon
-        obs['taxon'] = prune_taxon(obs['taxon'], taxon_key)
-        # Identifications: trim info, replace user and taxon objects
-        for ident in obs['identifications']:
-            if not ident['own_observation']:
-                ident = drop_fields(ident, 'uuid, own_observation, created_at_details', hard_prune_user=False)
-                identifier_key[ident['user']['id']] = ident['user']
-                ident['user'] = drop_fields(ident['user'], '')
-            else:
-                ident = drop_fields(ident, 'uuid, own_observation, created_at_details')
-            ident['taxon'] = prune_taxon(ident['taxon'], taxon_key)
-            if 'previous_observation_taxon' in ident:
-                ident['previous_observation_taxon'] = prune_taxon(ident['previous_observation_taxon'], taxon_key)
-        # Comments
-        for com in obs['comments']:
-            com = drop_fields(com, 'uuid, id, login, moderator_actions, flags, created_at_details, previous_observation_taxon_id')
-        # Annotations
-        for an in obs['annotations']:
-            an = drop_fields(an, 'uuid, controlled_value_id, controlled_attribute_id, vote_score')
-            an['votes'] = drop_fields(an['votes'], '')
-        # Flags
-        for flag in obs['flags']:
-            flag = drop_fields(flag, '')
-        # Ofvs
-        for obs_field in obs['ofvs']:
-            obs_field = drop_fields(obs_field, 'id, uuid, name_ci, value_ci')
-            if 'taxon' in obs_field:
-                obs_field['taxon'] = obs_field['taxon']['id']
-        # Votes
-        for vote in obs['votes']:
-            vote = drop_fields(vote, 'id')
-        # Quality metrics
-        for metric in obs['quality_metrics']:
-            metric = drop_fields(metric, 'user_id, id')
+    observations = [prune_obs(obs, identifier_key, observer_key, taxon_key) for obs in iter_json_array(fname)]
+    count(records=len(observations), bytes_read=getsize(fname))
     return observations, identifier_key, observer_key, taxon_key
 
 
-# Prunes each file in this directory and puts the results in "<path>_condensed", combining their contents into one set of four files
-def prune_obs_folder(path):
+# (helper) Streaming version of prune_file: observations are parsed, pruned and written to out_fname one at
+# a time, so memory stays bounded by one raw record plus the keys. Returns just the keys.
+def prune_file_to(fname, out_fname):
+    print(f"Pruning '{basename(fname)}'")
+    identifier_key = {}
+    observer_key = {}
+    taxon_key = {}
+    writer = JsonArrayWriter(out_fname)
+    for obs in iter_json_array(fname):
+        writer.write(prune_obs(obs, identifier_key, observer_key, taxon_key))
+    writer.close()
+    return identifier_key, observer_key, taxon_key
+
+
+# Prunes each file in this directory and puts the results in "<path>_condensed", combining their contents into one set of four files.
+# Files are pruned in parallel across `workers` processes (default: one per core).
+@instrumented()
+def prune_obs_folder(path, workers=None):
     # Create as a separate set of files, don't overwrite
     write_dir = path + '_condensed'
     if exists(write_dir):
@@ -181,21 +456,21 @@ def prune_obs_folder(path):
     else:
         mkdir(write_dir)
 
-    fnames = sorted(glob(path+"/*.json"))
-    observations = []
+    # Prune files in parallel, each worker streaming its output to a part file and sending back only its keys
+    fnames = [name for name in sorted(glob(path+"/*.json")) if basename(name)[-6:] != '_clean']
+    part_dir = write_dir + '/parts'
+    if not exists(part_dir):
+        mkdir(part_dir)
+    parts = [f"{part_dir}/{basename(name)}" for name in fnames]
     identifier_key = {}
     observer_key = {}
     taxon_key = {}
-    for name in fnames:
-        if basename(name)[-6:] != '_clean':
-            obs, identifiers, observers, taxa = prune_file(name)
-            observations.extend(obs)
-            identifier_key = {**identifier_key, **identifiers}
-            observer_key = {**observer_key, **observers}
-            taxon_key = {**taxon_key, **taxa}
-
-    print("Re-sorting observations by ID...")
-    observations.sort(key=lambda obs: int(obs['id']))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for identifiers, observers, taxa in pool.map(prune_file_to, fnames, parts):
+            identifier_key.update(identifiers)
+            observer_key.update(observers)
+            taxon_key.update(taxa)
+
     print("Writing taxa to disk...")
     jwrite(taxon_key, write_dir + '/taxa.json')
     del taxon_key
@@ -205,60 +480,212 @@ def prune_obs_folder(path):
     print("Writing observers to disk...")
     jwrite(observer_key, write_dir + '/observers.json')
     del observer_key
-    print("Writing observations to disk...")
-    jwrite(observations, write_dir + '/obs.json')
-    del observations
-    
+    # Each part is already in ID order (the harvest uses order='asc'), so they can be merged as streams
+    print("Merging observations by ID and writing to disk...")
+    merged = write_merged([iter_json_array(part) for part in parts], write_dir + '/obs.json', f"{write_dir}/{STORE_NAME}")
+    rmtree(part_dir)
+    count(records=merged, bytes_read=sum(getsize(name) for name in fnames),
+          bytes_written=sum(getsize(f"{write_dir}/{name}") for name in ('obs.json', 'taxa.json', 'identifiers.json', 'observers.json')))
+
+
+# (helper) Writes the ID-sorted, de-duplicated merge of several ID-sorted observation streams, and the same
+# observations to the random-access store at store_fname, if given (see obsstore.py)
+def write_merged(streams, fname, store_fname=None) -> int:
+    writer = JsonArrayWriter(fname)
+    store = StoreWriter(store_fname) if store_fname else None
+    count = 0
+    for obs in merge_sorted(streams):
+        writer.write(obs)
+        if store:
+            store.write(obs)
+        count += 1
+    writer.close()
+    if store:
+        store.close()
+    return count
 
+
+@instrumented()
 def merge_final():
-    fnames = glob("obs/*/*.json")
-    obs = []
+    obs_files = []
     taxa = {}
     users = {}
-    for name in fnames:
-        with open(name) as f:
-            n = basename(name).split('.')[0]
-            if n == 'taxa':
-                taxa = {**taxa, **json.load(f)}
-            elif n == 'users':
-                users = {**users, **json.load(f)}
-            else:
-                obs.extend(json.load(f))
+    for name in sorted(glob("obs/*/*.json")):
+        n = basename(name).split('.')[0]
+        if n == 'taxa':
+            taxa.update(jload(name))
+        elif n in ('users', 'identifiers', 'observers'):
+            users.update(jload(name))
+        else:
+            obs_files.append(name)
     if not exists("Coccinellidae"): mkdir("Coccinellidae")
-    with open("Coccinellidae/obs.json", 'w') as f:
-        json.dump(obs, f, indent=2)
+    merged = write_merged([iter_json_array(name) for name in obs_files], "Coccinellidae/obs.json", f"Coccinellidae/{STORE_NAME}")
+    print(f"{merged} observations merged from {len(obs_files)} files")
     with open("Coccinellidae/taxa.json", 'w') as f:
         json.dump(taxa, f, indent=2)
     with open("Coccinellidae/users.json", 'w') as f:
         json.dump(users, f, indent=2)
+    count(records=merged, bytes_read=sum(getsize(name) for name in glob("obs/*/*.json")),
+          bytes_written=sum(getsize(f"Coccinellidae/{name}") for name in ('obs.json', 'taxa.json', 'users.json')))
+
+
+SYNC_STATE = '.sync'   # watermark + pending changes, kept in the condensed folder
+
+
+# (helper) Latest updated_at in a condensed obs.json, used as the watermark the first time a store is synced
+def latest_update(fname) -> str:
+    latest = None
+    for obs in iter_json_array(fname):
+        updated = datetime.fromisoformat(obs['updated_at'])
+        if updated.tzinfo is None:
+            updated = updated.replace(tzinfo=timezone.utc)
+        if latest is None or updated > latest:
+            latest = updated
+    return latest.isoformat()
+
+
+# Incremental refresh of a condensed folder: fetches only observations updated since the last sync (new IDs on
+# old observations included), prunes that delta, and upserts it by observation ID into obs.json and the taxon/user
+# keys (identifiers.json and observers.json, or merge_final()'s users.json). The pruned delta is also saved as
+# delta.json and its IDs queued in the sync state, for process.sync_derived() to patch the derived tables with.
+@instrumented()
+def sync_obs(filters=dict(created_d2="2022-03-31", taxon_id=48486, place_id=66741), store='observations'):
+    # every file the upsert rewrites has to be there before anything is fetched or replaced
+    key_files = dict(taxa=f"{store}/taxa.json", **user_key_files(store))
+    for fname in key_files.values():
+        if not exists(fname):
+            raise FileNotFoundError(f"'{fname}' is missing; can't sync '{store}'")
+    state = read_small(f"{store}/{SYNC_STATE}") or dict(watermark=None, pending=[])
+    if state['watermark'] is None:
+        print("First sync for this folder; finding latest update already saved...")
+        state['watermark'] = latest_update(store + '/obs.json')
+    # Taken before fetching, so anything updated mid-sync is picked up next time
+    next_watermark = datetime.now(timezone.utc).isoformat()
+
+    limiter = RateLimiter()
+    keys = dict(identifiers={}, observers={}, taxa={})
+    delta = []
+    last_id = None
+    print(f"Fetching observations updated since {state['watermark']}...")
+    while True:
+        limiter.wait()
+        page = get_observations(**filters, verifiable=True, updated_since=state['watermark'], per_page=OBS_PER_PAGE,
+                                order_by='id', order='asc', id_above=last_id)
+        delta.extend(prune_obs(obs, keys['identifiers'], keys['observers'], keys['taxa']) for obs in page['results'])
+        count(records=len(page['results']), pages=1)
+        print(f"{len(delta)} of {len(delta) - len(page['results']) + page['total_results']} retrieved")
+        if page['total_results'] <= OBS_PER_PAGE:
+            break
+        last_id = page['results'][-1]['id']
+
+    # The keys, delta.json and the pending IDs are all saved before obs.json is replaced. A crash part way leaves the
+    # watermark where it was, so re-running fetches the same delta and upserts it again, which changes nothing twice.
+    if delta:
+        print("Upserting into obs.json...")
+        total = write_merged([iter_json_array(store + '/obs.json'), delta], store + '/obs.json.tmp', f"{store}/{STORE_NAME}")
+        # keys were read back from JSON, so their IDs are strings
+        for fname in sorted(set(key_files.values())):
+            saved = jload(fname)
+            for name, key in keys.items():
+                if key_files[name] == fname:
+                    saved.update({str(k): v for k, v in key.items()})
+            write_small(saved, fname)
+        # delta.json holds every change process.sync_derived() hasn't applied yet
+        if state['pending'] and exists(store + '/delta.json'):
+            write_merged([iter_json_array(store + '/delta.json'), delta], store + '/delta.json.tmp')
+            replace(store + '/delta.json.tmp', store + '/delta.json')
+        else:
+            write_small(delta, store + '/delta.json')
+        state['pending'] = sorted(set(state['pending']) | {obs['id'] for obs in delta})
+        write_small(state, f"{store}/{SYNC_STATE}")
+        replace(store + '/obs.json.tmp', store + '/obs.json')
+        print(f"{len(delta)} observations updated; {total} in store")
+    state['watermark'] = next_watermark
+    write_small(state, f"{store}/{SYNC_STATE}")
+    return len(delta)
+
+
+TAXON_CACHE = 'taxon_cache.json'   # every taxon fetched so far, shared across runs and families
+TAXA_PER_REQUEST = 30              # most IDs the API accepts in one get_taxa_by_id call
+MAX_CONCURRENT = 4
+
+
+# (helper) Fetches taxa in full-size ID batches, a few batches in flight at once within the API budget
+def fetch_taxa_by_id(taxon_ids, workers=MAX_CONCURRENT) -> list:
+    taxon_ids = sorted(taxon_ids)
+    batches = [taxon_ids[i:i+TAXA_PER_REQUEST] for i in range(0, len(taxon_ids), TAXA_PER_REQUEST)]
+    limiter = RateLimiter(burst=workers)
+    def fetch(batch):
+        limiter.wait()
+        results = get_taxa_by_id(batch)['results']
+        count(records=len(results), pages=1)
+        return results
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return [taxon for results in pool.map(fetch, batches) for taxon in results]
+
+
+# (helper) Adds to the taxon cache every ancestor and current synonym of `taxa` that it doesn't already hold,
+# repeating for the new taxa's own ancestors/synonyms until nothing is missing
+def complete_ancestry(taxa, cache) -> int:
+    fetched = 0
+    while True:
+        to_fetch = set()
+        for taxon in taxa:
+            for related in taxon['ancestor_ids'] + (taxon.get('current_synonymous_taxon_ids') or []):
+                if str(related) not in cache:
+                    to_fetch.add(related)
+        if not to_fetch:
+            return fetched
+        print(f"Fetching {len(to_fetch)} taxa in {ceil(len(to_fetch) / TAXA_PER_REQUEST)} requests...")
+        taxa = [taxon_record(taxon) for taxon in fetch_taxa_by_id(to_fetch)]
+        for taxon in taxa:
+            cache[str(taxon['id'])] = taxon
+        fetched += len(taxa)
+        # anything the API didn't return would otherwise be asked for again forever
+        for missing in to_fetch - {taxon['id'] for taxon in taxa}:
+            cache[str(missing)] = dict(id=missing, ancestor_ids=[], missing=True)
+
+
+# Fetches the full ancestry of a condensed folder's taxa (every ancestor and synonym not yet known) and writes it
+# to '<store>/ancestry.json'. Fetched taxa go into the persistent TAXON_CACHE, so repeat runs make no requests.
+@instrumented()
+def import_ancestry(store='observations', cache_fname=TAXON_CACHE) -> dict:
+    taxa = jload(store + '/taxa.json')
+    cache = read_small(cache_fname, {})
+    cache.update({k: v for k, v in taxa.items() if k not in cache})
+    fetched = complete_ancestry(taxa.values(), cache)
+    write_small(cache, cache_fname)
+
+    ancestry = {}
+    for taxon in taxa.values():
+        for related in taxon['ancestor_ids'] + (taxon.get('current_synonymous_taxon_ids') or []):
+            if not cache[str(related)].get('missing'):
+                ancestry[str(related)] = cache[str(related)]
+    jwrite(ancestry, store + '/ancestry.json')
+    print(f"{len(ancestry)} ancestor/synonym taxa saved ({fetched} fetched)")
+    return ancestry
+
 
+# Writes the taxonomy table for a taxon: everything below it, plus its ancestry (e.g. 'coccinellidae.csv')
+def write_taxonomy_csv(taxon_id=48486, fname='coccinellidae.csv', cache_fname=TAXON_CACHE) -> None:
+    # get descendants
+    taxa = [taxon_record(taxon) for taxon in get_taxa(taxon_id=taxon_id, page='all')['results']]
+    # get ancestry
+    cache = read_small(cache_fname, {})
+    cache.update({str(taxon['id']): taxon for taxon in taxa})
+    complete_ancestry(taxa, cache)
+    write_small(cache, cache_fname)
+    ancestors = (cache[str(ancestor)] for ancestor in cache[str(taxon_id)]['ancestor_ids'] if ancestor != taxon_id)
+    taxa.extend(ancestor for ancestor in ancestors if not ancestor.get('missing'))
 
-# get descendants
-coccinellidae = get_taxa(taxon_id=48486, page='all')['results']
-# get ancestry
-coccinellidae.extend(get_taxa_by_id([48460,1,47120,372739,47158,184884,47208,71130,372852,471714])['results'])
-with open('coccinellidae.csv', 'w', newline='') as f:
-    writer = csv.writer(f)
-    print("Scanning")
-    writer.writerow(['id', 'synonyms', 'parent', 'name', 'common', 'rank', 'level', 'active', 'obs_worldwide', 'num_species'])
-    for tax in coccinellidae:
-        parent = tax['ancestor_ids'][-2] if len(tax['ancestor_ids']) > 1 else 0
-        common = tax.get('preferred_common_name', tax['name'])
-        writer.writerow([tax['id'], tax['current_synonymous_taxon_ids'], parent, tax['name'], common, tax['rank'], tax['rank_level'], tax['is_active'], tax['observations_count'], tax['complete_species_count']])
-
-
-    # for id,taxon in taxa.items():
-    #     for ancestor in taxon['ancestor_ids']:
-    #         if ancestor not in taxa and ancestor not in to_fetch:
-    #             to_fetch.add(ancestor)
-    #         else:
-    #             already_have += 1
-    # print(f"{len(to_fetch)} taxa needed.", end=" ")
-    # if Confirm.ask("View?"):
-    #     print(to_fetch)
-    # else:
-    #     with open('fetch_taxa.json', 'w') as f:
-    #         json.dump(sorted(list(to_fetch)), f)
+    with open(fname, 'w', newline='') as f:
+        writer = csv.writer(f)
+        print("Scanning")
+        writer.writerow(['id', 'synonyms', 'parent', 'name', 'common', 'rank', 'level', 'active', 'obs_worldwide', 'num_species'])
+        for tax in taxa:
+            parent = tax['ancestor_ids'][-2] if len(tax['ancestor_ids']) > 1 else 0
+            common = tax.get('preferred_common_name', tax['name'])
+            writer.writerow([tax['id'], tax['current_synonymous_taxon_ids'], parent, tax['name'], common, tax['rank'], tax['rank_level'], tax['is_active'], tax['observations_count'], tax['complete_species_count']])
 
 
 # (useful args for testing:)
@@ -266,3 +693,5 @@ with open('coccinellidae.csv', 'w', newline='') as f:
 # 463 results: dict(taxon_id=48486, place_id=48816)
 
 # import_obs(start_from_id=84868113, fname_prefix='obs3')
+# harvest_sharded(num_shards=4)
+# write_taxonomy_csv()
@@ -0,0 +1,149 @@
+import gzip
+from hashlib import sha256
+import json
+from os import environ, makedirs, remove, replace, scandir, stat, utime
+from os.path import exists
+from threading import Lock
+from time import time
+from uuid import uuid4
+
+# Drop-in, disk-cached versions of the pyinaturalist calls import.py makes. Responses are stored gzipped under
+# CACHE_DIR, addressed by a hash of the call name and its normalized parameters, and expire after a TTL; once
+# the cache passes MAX_BYTES the least recently used responses are evicted.
+#
+# Offline replay (set INAT_OFFLINE=1, or call set_offline()) serves only from the cache, ignoring TTLs, and raises
+# CacheMiss for anything not recorded. use_api() points the calls at another server, e.g. mock_server.py.
+# pyinaturalist and requests are only imported once a call actually goes out, so cache hits and offline runs
+# don't pay for them.
+
+CACHE_DIR = '.inat_cache'
+MAX_BYTES = 2 * 1024**3
+OBS_TTL = 24 * 3600          # observations change as IDs come in
+TAXA_TTL = 30 * 24 * 3600    # taxonomy rarely does
+
+settings = dict(offline=environ.get('INAT_OFFLINE') == '1', api_url=None, cache_dir=CACHE_DIR)
+stats = dict(hits=0, misses=0, bytes_read=0, bytes_written=0)
+lock = Lock()
+cache_bytes = None   # running total, measured on first write
+
+
+class CacheMiss(LookupError):
+    pass
+
+
+def set_offline(offline=True) -> None:
+    settings['offline'] = offline
+
+
+# Sends requests to another iNaturalist-compatible API root (e.g. 'http://localhost:8765/v1'), or back to
+# the real one with None
+def use_api(url=None) -> None:
+    settings['api_url'] = url
+
+
+# (helper) Same parameters -> same key, regardless of argument order or unset (None) options.
+# Responses from a use_api() server are kept apart from the real API's.
+def request_key(name, params) -> str:
+    normalized = {k: v for k, v in sorted(params.items()) if v is not None}
+    return sha256(json.dumps([settings['api_url'], name, normalized], sort_keys=True, default=str).encode()).hexdigest()
+
+
+def cache_path(key) -> str:
+    return f"{settings['cache_dir']}/{key[:2]}/{key}.json.gz"
+
+
+# (helper) Serves a call from the cache if there's a fresh enough copy; otherwise makes it and records the response
+def cached_call(name, fetch, ttl, params):
+    path = cache_path(request_key(name, params))
+    if exists(path) and (settings['offline'] or time() - stat(path).st_mtime < ttl):
+        with open(path, 'rb') as f:
+            data = f.read()
+        # access time marks recent use for eviction; modification time stays the recording time for the TTL
+        utime(path, (time(), stat(path).st_mtime))
+        with lock:
+            stats['hits'] += 1
+            stats['bytes_read'] += len(data)
+        return json.loads(gzip.decompress(data))
+    if settings['offline']:
+        raise CacheMiss(f"{name}({params}) is not in the cache")
+
+    response = fetch()
+    data = gzip.compress(json.dumps(response, default=str).encode())
+    makedirs(path.rsplit('/', 1)[0], exist_ok=True)
+    tmp = f"{path}.{uuid4().hex}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    replace(tmp, path)
+    with lock:
+        stats['misses'] += 1
+        stats['bytes_written'] += len(data)
+    track_size(len(data))
+    return response
+
+
+# (helper) Keeps the cache under MAX_BYTES by deleting the least recently used responses
+def track_size(added) -> None:
+    global cache_bytes
+    with lock:
+        if cache_bytes is None:
+            cache_bytes = sum(entry.stat().st_size for entry in cache_entries())
+        else:
+            cache_bytes += added
+        if cache_bytes <= MAX_BYTES:
+            return
+        entries = sorted(cache_entries(), key=lambda entry: entry.stat().st_atime)
+        while entries and cache_bytes > MAX_BYTES * 0.9:
+            entry = entries.pop(0)
+            cache_bytes -= entry.stat().st_size
+            remove(entry.path)
+
+
+def cache_entries():
+    if not exists(settings['cache_dir']):
+        return
+    for folder in scandir(settings['cache_dir']):
+        if folder.is_dir():
+            yield from (entry for entry in scandir(folder.path) if entry.name.endswith('.json.gz'))
+
+
+# (helper) Makes a call against use_api()'s server instead of through pyinaturalist
+def get_json(endpoint, params):
+    import requests
+    def encode(value):
+        if isinstance(value, bool):
+            return str(value).lower()
+        if isinstance(value, (list, tuple)):
+            return ','.join(map(str, value))
+        return value
+    params = {k: encode(v) for k, v in params.items() if v is not None}
+    response = requests.get(f"{settings['api_url']}/{endpoint}", params=params, timeout=60)
+    response.raise_for_status()
+    return response.json()
+
+
+def get_observations(**params):
+    def fetch():
+        if settings['api_url']:
+            return get_json('observations', params)
+        import pyinaturalist
+        return pyinaturalist.get_observations(**params)
+    return cached_call('get_observations', fetch, OBS_TTL, params)
+
+
+def get_taxa(**params):
+    def fetch():
+        if settings['api_url']:
+            return get_json('taxa', params)
+        import pyinaturalist
+        return pyinaturalist.get_taxa(**params)
+    return cached_call('get_taxa', fetch, TAXA_TTL, params)
+
+
+def get_taxa_by_id(taxon_id, **params):
+    def fetch():
+        if settings['api_url']:
+            ids = taxon_id if isinstance(taxon_id, (list, tuple)) else [taxon_id]
+            return get_json('taxa/' + ','.join(map(str, ids)), params)
+        import pyinaturalist
+        return pyinaturalist.get_taxa_by_id(taxon_id, **params)
+    return cached_call('get_taxa_by_id', fetch, TAXA_TTL, dict(params, taxon_id=taxon_id))
@@ -0,0 +1,213 @@
+import atexit
+import cProfile
+from datetime import datetime, timezone
+from functools import wraps
+import json
+from os import environ, makedirs, register_at_fork, sysconf, times
+import platform
+import resource
+import sys
+from threading import Lock, Thread
+from time import perf_counter, process_time, sleep
+
+from rich import print
+
+# Per-stage instrumentation for the pipeline. Each instrumented stage (import_obs, prune_obs_folder, export_all,
+# build_stats_table, ...) records wall and CPU time (its own and its worker processes'), peak memory, records and
+# API pages per second, bytes read and written, and inat_cache hit rates for the calls it made. Stages go into a
+# JSON run report, written at exit when a report file is set:
+#   INAT_REPORT=reports/run.json python cli.py fetch      (or: python cli.py --report reports/run.json fetch)
+#   INAT_PROFILE=prune_obs_folder,export_all ...          cProfile the named stages ('all' for every stage)
+#   python cli.py compare reports/old.json reports/new.json
+#
+# Stages are marked with @instrumented(), and add to their counts with count(records=..., pages=..., ...).
+# Counts go to every stage still running, so a nested stage's records also count for the stage around it.
+
+PROFILE_DIR = 'profiles'
+SAMPLE_SECONDS = 0.05
+
+settings = dict(report=environ.get('INAT_REPORT'),
+                profile={name for name in environ.get('INAT_PROFILE', '').split(',') if name})
+stages = []        # finished stages, in the order they finished
+running = []       # stages still in progress, outermost first
+lock = Lock()
+sampler = None
+
+
+# (helper) Forked worker processes (e.g. harvest_sharded's) start with no stages and don't write reports; this
+# also replaces a lock the sampler thread might have held at the moment of the fork
+def reset_after_fork() -> None:
+    global lock, sampler
+    lock = Lock()
+    sampler = None
+    running.clear()
+    stages.clear()
+    settings['report'] = None
+
+
+register_at_fork(after_in_child=reset_after_fork)
+
+
+# (helper) Current resident memory in bytes, or None where /proc isn't available
+def current_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+# (helper) Background thread keeping every running stage's peak memory up to date
+def sample_memory() -> None:
+    while True:
+        rss = current_rss()
+        if rss is None:
+            return
+        with lock:
+            for stage in running:
+                stage.peak_rss = max(stage.peak_rss, rss)
+        sleep(SAMPLE_SECONDS)
+
+
+# (helper) Snapshot of inat_cache's counters, if it's been imported (it's never imported just for this)
+def cache_stats() -> dict:
+    inat_cache = sys.modules.get('inat_cache')
+    return dict(inat_cache.stats) if inat_cache else dict(hits=0, misses=0, bytes_read=0, bytes_written=0)
+
+
+class Stage:
+    def __init__(self, name):
+        self.name = name
+        self.counts = dict(records=0, pages=0, bytes_read=0, bytes_written=0)
+        self.started = datetime.now(timezone.utc)
+        self.peak_rss = current_rss() or 0
+        self.profiler = None
+        self.wall = perf_counter()
+        self.cpu = process_time()
+        self.children_cpu = sum(times()[2:4])
+        self.cache = cache_stats()
+
+    def finish(self, error=None) -> dict:
+        wall = perf_counter() - self.wall
+        cache = {k: v - self.cache[k] for k, v in cache_stats().items()}
+        lookups = cache['hits'] + cache['misses']
+        rss = current_rss()
+        report = dict(stage=self.name, started=self.started.isoformat(), wall_seconds=round(wall, 4),
+                      cpu_seconds=round(process_time() - self.cpu, 4),
+                      children_cpu_seconds=round(sum(times()[2:4]) - self.children_cpu, 4),
+                      # with no /proc, the process's peak so far is the best available
+                      peak_rss_mb=round((max(self.peak_rss, rss) if rss else
+                                         resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024) / 2**20, 1),
+                      children_peak_rss_mb=round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+                      **self.counts,
+                      records_per_second=round(self.counts['records'] / wall, 1) if wall else None,
+                      pages_per_second=round(self.counts['pages'] / wall, 3) if wall else None,
+                      cache_hits=cache['hits'], cache_misses=cache['misses'],
+                      cache_hit_rate=round(cache['hits'] / lookups, 4) if lookups else None,
+                      cache_bytes_read=cache['bytes_read'], cache_bytes_written=cache['bytes_written'])
+        if error is not None:
+            report['error'] = repr(error)
+        return report
+
+
+# Decorator marking a function as a pipeline stage
+def instrumented(name=None):
+    def decorate(func):
+        stage_name = name or func.__name__
+
+        @wraps(func)
+        def run(*args, **kwargs):
+            global sampler
+            stage = Stage(stage_name)
+            with lock:
+                running.append(stage)
+            if sampler is None:
+                sampler = Thread(target=sample_memory, daemon=True)
+                sampler.start()
+            # one profiler at a time, so a profiled stage inside another profiled stage is covered by the outer one
+            if (stage_name in settings['profile'] or 'all' in settings['profile']) and \
+                    not any(outer.profiler for outer in running[:-1]):
+                stage.profiler = cProfile.Profile()
+                stage.profiler.enable()
+            error = None
+            try:
+                return func(*args, **kwargs)
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                if stage.profiler:
+                    stage.profiler.disable()
+                    makedirs(PROFILE_DIR, exist_ok=True)
+                    stage.profiler.dump_stats(f"{PROFILE_DIR}/{stage_name}-{stage.started:%Y%m%dT%H%M%S}.prof")
+                with lock:
+                    running.remove(stage)
+                report = stage.finish(error)
+                stages.append(report)
+                if settings['report'] and not running:
+                    print(f"[dim]{stage_name}: {report['wall_seconds']:.1f} s, {report['records']:,} records "
+                          f"({report['records_per_second'] or 0:,.0f}/s), peak {report['peak_rss_mb']:,.0f} MB[/dim]")
+        return run
+    return decorate
+
+
+# Adds to the counts (records, pages, bytes_read, bytes_written) of every running stage
+def count(**amounts) -> None:
+    with lock:
+        for stage in running:
+            for key, amount in amounts.items():
+                stage.counts[key] += amount
+
+
+def run_report() -> dict:
+    return dict(finished=datetime.now(timezone.utc).isoformat(), argv=sys.argv, python=platform.python_version(),
+                platform=platform.platform(), stages=stages)
+
+
+def write_report(fname=None) -> None:
+    fname = fname or settings['report']
+    if '/' in fname:
+        makedirs(fname.rsplit('/', 1)[0], exist_ok=True)
+    with open(fname, 'w') as f:
+        json.dump(run_report(), f, indent=2)
+
+
+# Writes the run report at exit (if anything ran)
+def report_to(fname) -> None:
+    settings['report'] = fname
+
+
+@atexit.register
+def write_report_at_exit() -> None:
+    if settings['report'] and stages:
+        write_report()
+
+
+# Compares two run reports stage by stage (summing repeated stages, and keeping benchmark scales apart); returns
+# the stages that got slower or used more memory by more than `tolerance`
+def compare(old_fname, new_fname, tolerance=0.2) -> list:
+    def totals(fname):
+        with open(fname) as f:
+            report = json.load(f)
+        by_stage = {}
+        for stage in report['stages']:
+            # benchmark reports tag each stage with the scale it ran at
+            name = f"{stage['stage']}@{stage['scale']}" if 'scale' in stage else stage['stage']
+            total = by_stage.setdefault(name, dict(wall_seconds=0, records=0, peak_rss_mb=0))
+            total['wall_seconds'] += stage['wall_seconds']
+            total['records'] += stage['records']
+            total['peak_rss_mb'] = max(total['peak_rss_mb'], stage['peak_rss_mb'])
+        return by_stage
+
+    old, new = totals(old_fname), totals(new_fname)
+    regressions = []
+    for name in sorted(old.keys() & new.keys()):
+        for metric in ('wall_seconds', 'peak_rss_mb'):
+            before, after = old[name][metric], new[name][metric]
+            change = (after - before) / before if before else 0
+            flag = change > tolerance
+            print(f"{'[red]' if flag else ''}{name:<20} {metric:<13} {before:>10,.2f} -> {after:>10,.2f} ({change:+.0%})"
+                  f"{'[/red]' if flag else ''}")
+            if flag:
+                regressions.append((name, metric, before, after))
+    return regressions
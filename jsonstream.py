@@ -0,0 +1,108 @@
+import heapq
+import json
+from os import replace
+from os.path import exists
+
+# Helpers for writing and reading big JSON arrays one record at a time, so nothing
+# has to hold a whole 20k-obs file in memory. Output is still a plain JSON array, so jload() can
+# read it the same as before.
+
+
+# Atomically writes a small JSON file (e.g. a checkpoint), so a crash never leaves it half-written
+def write_small(data, fname) -> None:
+    tmp = fname + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=2, default=str)
+    replace(tmp, fname)
+
+
+def read_small(fname, default=None):
+    if not exists(fname):
+        return default
+    with open(fname) as f:
+        return json.load(f)
+
+
+# Appends records to a JSON array on disk. Passing the byte offset from an earlier run (as
+# recorded by a checkpoint) truncates any partial write past that point and continues the array.
+# The file must still be there to continue it: starting a fresh one at that offset would pad it with NULs.
+class JsonArrayWriter:
+    def __init__(self, fname, offset=0, indent=2):
+        if offset and not exists(fname):
+            raise FileNotFoundError(f"Can't continue '{fname}' from byte {offset}: the file is missing")
+        self.fname = fname
+        self.indent = indent
+        self.f = open(fname, 'r+b' if offset else 'wb')
+        self.f.seek(offset)
+        self.f.truncate()
+        self.empty = offset == 0
+
+    @property
+    def offset(self) -> int:
+        return self.f.tell()
+
+    def write(self, record) -> None:
+        self.f.write(b'[\n' if self.empty else b',\n')
+        self.f.write(json.dumps(record, indent=self.indent, default=str).encode())
+        self.empty = False
+
+    def flush(self) -> None:
+        self.f.flush()
+
+    # Terminates the array; an empty writer still produces a valid (empty) array
+    def close(self) -> None:
+        self.f.write(b'[]\n' if self.empty else b'\n]\n')
+        self.f.close()
+
+
+# Yields the records of a JSON array file one at a time, reading it in chunks, so memory use is
+# bounded by the largest single record rather than the size of the file
+def iter_json_array(fname, chunk_size=1 << 20):
+    decoder = json.JSONDecoder()
+    with open(fname) as f:
+        buf = f.read(chunk_size)
+        pos = len(buf) - len(buf.lstrip())
+        if buf[pos:pos+1] != '[':
+            raise ValueError(f"'{fname}' does not contain a JSON array")
+        pos += 1
+        while True:
+            # Skip separators, topping up the buffer when it runs dry
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos == len(buf):
+                more = f.read(chunk_size)
+                if not more:
+                    raise ValueError(f"'{fname}' ends before its array is closed")
+                buf, pos = more, 0
+                continue
+            if buf[pos] == ']':
+                return
+            try:
+                record, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                # Most likely the record runs past the end of the buffer
+                more = f.read(chunk_size)
+                if not more:
+                    raise
+                buf, pos = buf[pos:] + more, 0
+                continue
+            yield record
+            pos = end
+            if pos > chunk_size:
+                buf, pos = buf[pos:], 0
+
+
+# k-way merges several streams that are each already sorted by key (e.g. ID-ordered observation files)
+# into one sorted stream, holding just one pending record per stream. Records sharing a key are
+# collapsed into one, with the record from the later stream winning.
+def merge_sorted(streams, key=lambda record: record['id']):
+    prev = None
+    for record in heapq.merge(*streams, key=key):
+        if prev is not None:
+            if key(record) < key(prev):
+                raise ValueError(f"Input is not sorted: {key(record)} came after {key(prev)}")
+            if key(record) != key(prev):
+                yield prev
+        prev = record
+    if prev is not None:
+        yield prev
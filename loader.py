@@ -0,0 +1,51 @@
+from glob import glob
+from hashlib import sha1
+from os import makedirs, remove, stat
+from os.path import abspath, basename, exists
+
+import pandas as pd
+
+# Shared loader for the identification tables the notebooks start from ('identifications.csv',
+# 'idents_expanded.csv', 'identifications-coccinellidae.csv'). Dates are normalized to naive UTC and split into
+# date/time columns, then the result is cached as a pickle keyed by the CSV's path, size and mtime, the options
+# it was loaded with and LOADER_VERSION, so later loads of an unchanged file skip the parsing entirely.
+
+CACHE_DIR = '.cache'
+LOADER_VERSION = 2   # bump whenever load_identifications() parses differently, so older caches aren't served
+
+
+# (helper) short hex digest of some text, for cache names
+def digest(text) -> str:
+    return sha1(str(text).encode()).hexdigest()[:12]
+
+
+# (helper) Cache file name for fname as loaded with these options: '<name>-<path>-<version>-<options>.pkl', where
+# <path> tells same-named CSVs in different folders apart and <version> changes with the file and the loader
+def cache_name(fname, index_col=None, cache_dir=CACHE_DIR) -> str:
+    info = stat(fname)
+    version = digest(f"{info.st_size}|{info.st_mtime_ns}|{LOADER_VERSION}")
+    return f"{cache_dir}/{basename(fname)}-{digest(abspath(fname))}-{version}-{digest(repr(index_col))}.pkl"
+
+
+def load_identifications(fname='identifications.csv', index_col=None, cache_dir=CACHE_DIR) -> pd.DataFrame:
+    cached = cache_name(fname, index_col, cache_dir)
+    if exists(cached):
+        return pd.read_pickle(cached)
+
+    ids = pd.read_csv(fname, index_col=index_col)
+    standard_times = pd.to_datetime(ids['date'], utc=True, format='ISO8601').dt.tz_localize(None)
+    ids.insert(3, 'datetime', standard_times)
+    ids['date'] = standard_times.dt.date
+    ids.insert(5, 'time', standard_times.dt.time)
+    if 'places' in ids.columns:
+        ids['places'] = [[int(x) for x in places.strip('[]').split(', ') if x] for places in ids['places']]
+    ids.sort_values(by='date', inplace=True)
+
+    # Drop caches of older versions of this file (this path only, any options) before saving the new one
+    makedirs(cache_dir, exist_ok=True)
+    current = cached.rsplit('-', 1)[0]
+    for old in glob(f"{cache_dir}/{basename(fname)}-{digest(abspath(fname))}-*.pkl"):
+        if old.rsplit('-', 1)[0] != current:
+            remove(old)
+    ids.to_pickle(cached)
+    return ids
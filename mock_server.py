@@ -0,0 +1,114 @@
+import argparse
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from glob import glob
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+from threading import Thread
+from time import sleep
+from urllib.parse import parse_qs, urlparse
+
+from jsonstream import iter_json_array
+from synthetic import SyntheticObs
+
+# Local stand-in for the parts of the iNaturalist v1 API that import.py uses (observations by ID cursor, taxa),
+# so the fetch pipeline can be tested and benchmarked without network access:
+#   python mock_server.py --data obs             serves raw observations recorded by import_obs()
+#   python mock_server.py --synthetic 100000     serves generated ones
+# then point the calls at it with inat_cache.use_api('http://localhost:8765/v1').
+# Query filters other than the ID/date cursors (taxon_id, place_id, ...) are accepted and ignored.
+
+MAX_PER_PAGE = 200
+
+
+class MockData:
+    # taxa: extra raw taxa to serve besides those the observations mention (e.g. their ancestors)
+    def __init__(self, observations, taxa=()):
+        self.observations = sorted(observations, key=lambda obs: obs['id'])
+        self.ids = [obs['id'] for obs in self.observations]
+        self.taxa = {taxon['id']: taxon for taxon in taxa}
+        for obs in self.observations:
+            for ident in obs['identifications']:
+                self.taxa[ident['taxon']['id']] = ident['taxon']
+        self.taxon_ids = sorted(self.taxa)
+
+    @classmethod
+    def from_folder(cls, path):
+        return cls([obs for fname in sorted(glob(path + '/*.json')) for obs in iter_json_array(fname)])
+
+    # Observations from synthetic.py, with the whole taxonomy they're drawn from
+    @classmethod
+    def synthetic(cls, num_obs, seed=0):
+        observations = SyntheticObs(num_obs, seed)
+        return cls(list(observations), observations.all_taxa())
+
+
+# (helper) v1-shaped page of records whose IDs fall within the query's id_above/id_below cursor
+def page_of(records, ids, query):
+    lo = bisect_right(ids, int(query['id_above'])) if 'id_above' in query else 0
+    hi = bisect_left(ids, int(query['id_below'])) if 'id_below' in query else len(ids)
+    matches = records[lo:hi]
+    if 'updated_since' in query:
+        since = datetime.fromisoformat(query['updated_since'])
+        matches = [r for r in matches if datetime.fromisoformat(r['updated_at']) > since]
+    if query.get('order') == 'desc':
+        matches = matches[::-1]
+    per_page = min(int(query.get('per_page', 30)), MAX_PER_PAGE)
+    if query.get('page') == 'all':
+        per_page = len(matches)
+    page = int(query['page']) if query.get('page', '').isdigit() else 1
+    return dict(total_results=len(matches), page=page, per_page=per_page,
+                results=matches[(page - 1) * per_page:page * per_page])
+
+
+def make_handler(data, latency=0.0):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            if latency:
+                sleep(latency)
+            if url.path == '/v1/observations':
+                body = page_of(data.observations, data.ids, query)
+            elif url.path == '/v1/taxa':
+                body = page_of([data.taxa[t] for t in data.taxon_ids], data.taxon_ids, query)
+            elif url.path.startswith('/v1/taxa/'):
+                wanted = [int(t) for t in url.path.rsplit('/', 1)[1].split(',')]
+                results = [data.taxa[t] for t in wanted if t in data.taxa]
+                body = dict(total_results=len(results), page=1, per_page=len(results), results=results)
+            else:
+                self.send_error(404)
+                return
+            payload = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+    return Handler
+
+
+# Starts the server in a background thread and returns it (call .shutdown() to stop); the API root is
+# f"http://localhost:{server.server_port}/v1"
+def serve(data, port=8765, latency=0.0):
+    server = ThreadingHTTPServer(('localhost', port), make_handler(data, latency))
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve recorded or synthetic iNaturalist v1 API pages locally")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--data', help="folder of raw observation files written by import_obs()")
+    source.add_argument('--synthetic', type=int, metavar='N', help="serve N generated observations")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds to wait before answering each request")
+    args = parser.parse_args()
+
+    data = MockData.from_folder(args.data) if args.data else MockData.synthetic(args.synthetic)
+    server = ThreadingHTTPServer(('localhost', args.port), make_handler(data, args.latency))
+    print(f"Serving {len(data.observations)} observations at http://localhost:{args.port}/v1")
+    server.serve_forever()
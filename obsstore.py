@@ -0,0 +1,185 @@
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+import json
+import mmap
+from os import replace
+from os.path import dirname, exists, join
+import struct
+import zlib
+
+from jsonstream import iter_json_array
+
+# Random-access copy of a condensed obs.json: the same observations as newline-delimited JSON, compressed in blocks
+# of BLOCK_RECORDS, plus a sidecar index ('<store>.idx') of every observation's ID and its offset in its block.
+# Both files are memory-mapped, so opening a store reads nothing up front, and a lookup is a binary search of
+# the ID column followed by decompressing one block.
+#
+#   store = ObsStore('observations/obs.store')
+#   store[84868113]                              one observation
+#   store.scan(80_000_000, 90_000_000)           every observation with an ID in [start, end)
+#   map_chunks(count_ids, 'observations/obs.store', workers=8)
+#
+# write_merged() in import.py keeps a store next to each obs.json it writes; build_store() makes one for an
+# existing obs.json.
+
+STORE_NAME = 'obs.store'
+BLOCK_RECORDS = 256
+MAGIC = b'OBSTORE1'
+HEADER = struct.Struct('<8sqqq')   # magic, records, blocks, records per block
+
+
+# Where a condensed folder keeps each key of users: prune_obs_folder() writes identifiers.json and observers.json,
+# merge_final() combines them into one users.json. Returns {'identifiers': fname, 'observers': fname}.
+def user_key_files(folder) -> dict:
+    split = {role: f"{folder}/{role}.json" for role in ('identifiers', 'observers')}
+    if all(exists(fname) for fname in split.values()):
+        return split
+    if exists(f"{folder}/users.json"):
+        return dict.fromkeys(split, f"{folder}/users.json")
+    raise FileNotFoundError(f"'{folder}' has neither identifiers.json and observers.json nor users.json")
+
+
+class StoreWriter:
+    def __init__(self, fname, block_records=BLOCK_RECORDS, level=6):
+        self.fname = fname
+        self.block_records = block_records
+        self.level = level
+        self.f = open(fname + '.tmp', 'wb')
+        self.ids = array('q')
+        self.offsets = array('q')          # where each record starts in its decompressed block
+        self.block_starts = array('q', [0])
+        self.block = []
+        self.block_len = 0
+
+    def write(self, obs) -> None:
+        if self.ids and obs['id'] <= self.ids[-1]:
+            raise ValueError(f"observation {obs['id']} written after {self.ids[-1]}; the store must be in ID order")
+        line = json.dumps(obs, separators=(',', ':'), ensure_ascii=False, default=str).encode() + b'\n'
+        self.ids.append(obs['id'])
+        self.offsets.append(self.block_len)
+        self.block.append(line)
+        self.block_len += len(line)
+        if len(self.block) == self.block_records:
+            self.flush_block()
+
+    def flush_block(self) -> None:
+        if self.block:
+            self.f.write(zlib.compress(b''.join(self.block), self.level))
+            self.block_starts.append(self.f.tell())
+            self.block = []
+            self.block_len = 0
+
+    def close(self) -> None:
+        self.flush_block()
+        self.f.close()
+        with open(self.fname + '.idx.tmp', 'wb') as f:
+            f.write(HEADER.pack(MAGIC, len(self.ids), len(self.block_starts) - 1, self.block_records))
+            for column in (self.ids, self.offsets, self.block_starts):
+                if column.itemsize != 8:
+                    raise RuntimeError("the store index needs 64-bit array('q') columns")
+                column.tofile(f)
+        # data first, so a crash in between leaves an index that's too short rather than one that's wrong
+        replace(self.fname + '.tmp', self.fname)
+        replace(self.fname + '.idx.tmp', self.fname + '.idx')
+
+
+# Copies an existing condensed obs.json into a store (it's already in ID order); returns the number of observations
+def build_store(src='observations/obs.json', fname=None, block_records=BLOCK_RECORDS) -> int:
+    writer = StoreWriter(fname or join(dirname(src), STORE_NAME), block_records)
+    for obs in iter_json_array(src):
+        writer.write(obs)
+    writer.close()
+    return len(writer.ids)
+
+
+class ObsStore:
+    def __init__(self, fname='observations/' + STORE_NAME):
+        self.fname = fname
+        with open(fname + '.idx', 'rb') as f:
+            self.index_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.num_records, self.num_blocks, self.block_records = HEADER.unpack_from(self.index_map)
+        if magic != MAGIC:
+            raise ValueError(f"'{fname}.idx' is not an observation store index")
+        self.columns = memoryview(self.index_map)[HEADER.size:].cast('q')
+        n = self.num_records
+        self.ids = self.columns[:n]
+        self.offsets = self.columns[n:2 * n]
+        self.block_starts = self.columns[2 * n:2 * n + self.num_blocks + 1]
+        with open(fname, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.block_starts[-1] else b''
+        self.cached = (None, None)   # last decompressed block, so neighbouring lookups don't repeat the work
+
+    def __len__(self):
+        return self.num_records
+
+    def __contains__(self, obs_id):
+        return self.position(obs_id) is not None
+
+    def __getitem__(self, obs_id):
+        i = self.position(obs_id)
+        if i is None:
+            raise KeyError(obs_id)
+        return self.record(i)
+
+    def get(self, obs_id, default=None):
+        i = self.position(obs_id)
+        return default if i is None else self.record(i)
+
+    def __iter__(self):
+        return self.scan()
+
+    # (helper) position of obs_id in the ID column, or None if it isn't stored
+    def position(self, obs_id):
+        i = bisect_left(self.ids, obs_id)
+        return i if i < self.num_records and self.ids[i] == obs_id else None
+
+    def read_block(self, b) -> bytes:
+        if self.cached[0] != b:
+            self.cached = (b, zlib.decompress(self.data[self.block_starts[b]:self.block_starts[b + 1]]))
+        return self.cached[1]
+
+    def record(self, i) -> dict:
+        block = self.read_block(i // self.block_records)
+        end = self.offsets[i + 1] if (i + 1) % self.block_records and i + 1 < self.num_records else len(block)
+        return json.loads(block[self.offsets[i]:end])
+
+    # Observations with start <= ID < end (either bound may be None), in ID order, decompressing each block once
+    def scan(self, start=None, end=None):
+        lo = 0 if start is None else bisect_left(self.ids, start)
+        hi = self.num_records if end is None else bisect_left(self.ids, end)
+        for b in range(lo // self.block_records, (hi - 1) // self.block_records + 1 if hi > lo else 0):
+            first = b * self.block_records
+            lines = self.read_block(b).splitlines()
+            for line in lines[max(lo - first, 0):hi - first]:
+                yield json.loads(line)
+
+    # Splits the store into about n ID ranges of whole blocks, as (start, end) bounds for scan()
+    def chunks(self, n):
+        n = max(min(n, self.num_blocks), 1)
+        bounds = [self.ids[round(k * self.num_blocks / n) * self.block_records] for k in range(1, n)]
+        return list(zip([None] + bounds, bounds + [None]))
+
+    def close(self) -> None:
+        for view in (self.ids, self.offsets, self.block_starts, self.columns):
+            view.release()
+        self.index_map.close()
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+
+# (helper) runs in a worker process: func over one chunk's observations
+def scan_chunk(func, fname, start, end):
+    store = ObsStore(fname)
+    return func(store.scan(start, end))
+
+
+# Calls func(observations) on `workers` chunks of the store in parallel and returns the results in ID order.
+# func must be a module-level function, so it can be sent to the worker processes.
+def map_chunks(func, fname='observations/' + STORE_NAME, workers=None, chunks=None) -> list:
+    store = ObsStore(fname)
+    bounds = store.chunks(chunks or workers or 8)
+    store.close()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(scan_chunk, [func] * len(bounds), [fname] * len(bounds),
+                             [start for start, _ in bounds], [end for _, end in bounds]))
@@ -1,17 +1,23 @@
+from __future__ import annotations
+
 import csv
 from collections import defaultdict
 from copy import copy
 from glob import glob
+import heapq
 import json
+from os import remove, replace
+from os.path import exists, getsize
 import re
+from shutil import rmtree
 
-import pandas as pd
-import numpy as np
-from dateutil.parser import isoparse
 from rich import print
-from rich.traceback import install
-install(show_locals=True)
-install(suppress=[pd, np])
+
+from instrument import count, instrumented
+from jsonstream import iter_json_array, write_small
+
+# pandas, numpy and the other heavy libraries are imported inside the functions that use them, so importing this
+# module (or running one stage from cli.py) doesn't load them all up front
 
 def jload(fname) -> str:
     with open(fname) as f:
@@ -33,122 +39,272 @@ def del_fields(doc: dict, fields: str) -> dict:
     return doc
 
 
-# DEFUNCT?
-def build_identifier_activity_key():
-    # build int:list[dict] identifier key, with activity history indexed by user ID 
-    IDer_key = {}
-    user_key = jload('import final/users.json')
-    action_names = 'identifications, comments, flags, votes'.split(", ")
-    with open('import final/obs.json') as f:
-        observations = json.load(f)
-    # check activities attached to each observation
-    for obs in observations:
-        for act_name in action_names:
-            for act_obj in obs[act_name]:
-                user_id = act_obj['user']['id']
-                log = dict(obs=obs['id'], time=act_obj['created_at'], action=act_name[:-1])
-
-                if user_id not in IDer_key and act_name == 'identifications' and user_id != obs['user']['id']:
-                    # update user entry and transfer to IDer_key
-                    IDer_key[user_id] = user_key[user_id]
-                    if 'coccinellidae_ids_count' not in IDer_key[user_id]:
-                        IDer_key[user_id]['coccinellidae_ids_count'] = 0
-                    if 'activity' not in IDer_key[user_id]:
-                        IDer_key[user_id]['activity'] = []
-                    IDer_key[user_id]['activity'].append(log)
-                    IDer_key[user_id]['coccinellidae_ids_count'] += 1
-                    del user_key[user_id]
-
-                elif user_id not in IDer_key and act_name != 'identifications':
-                    if 'activity' not in IDer_key[user_id]:
-                        IDer_key[user_id]['activity'] = []
-                    user_key[user_id]['activity'].append(log)
-                
-                elif user_id in IDer_key:
-                    if act_name == 'identifications':
-                        IDer_key[user_id]['coccinellidae_ids_count'] += 1
-                    IDer_key[user_id]['activity'].append(log)
-    del observations, obs, user_key
-
-    # rearrange for pandas so that the count and activity log are user properties
-    with open('import final/users.json') as f:
-        users = json.load(f)
-    IDer_list = []
-    for user in users:
-        if user['id'] in IDer_key:
-            user['activity'] = IDer_key[user['id']]
-            user['coccinellidae_ids_count'] = IDer_key[user['id']]
-            IDer_list.append(user)
-    del users
-
-    for user in IDer_list:
-        try:
-            user['activity'].sort(key=lambda a: isoparse(a['time']))
-        except Exception as e:
-            print(f"Problem with user {user_id}:", e)
-            # one error, "can't compare offset-naive and offset-aware datetimes"; problem appears to be with "2021-09-09T01:48:05"? it's not even an ID it's a vote, just ignore it
-    with open('import final/identifiers_pandas2.json', 'w') as f:
-        json.dump(IDer_list, f, indent=2)
-
-
+# Every user's identifications, comments, flags and votes as one timeline table sorted by (user, time); see
+# activity.py. Replaces the per-user activity lists this used to build in 'import final/identifiers_pandas2.json'.
+@instrumented()
+def build_activity_index(src='observations/obs.json', fname='observations/activity.pkl'):
+    from activity import ActivityIndex
+    index = ActivityIndex.from_obs(src)
+    index.save(fname)
+    count(records=len(index), bytes_read=getsize(src), bytes_written=getsize(fname))
+    return index
+
+
+# Single-pass export: streams the condensed observations once and hands each one to every sink, so each
+# derived table costs one read of obs.json between them rather than one read apiece.
+# A sink is anything with add(obs) and close() methods; see the *Sink classes below.
+@instrumented()
+def export_all(sinks=None, src='observations/obs.json'):
+    if sinks is None:
+        cocci = cocci_taxon_ids()
+        sinks = [IdsSink(), ObsSink(), IdsSink(COCCI_IDS_CSV, taxon_ids=cocci, index=True), LatestIdsSink(taxon_ids=cocci)]
+    print("Scanning")
+    records = 0
+    for obs in iter_json_array(src):
+        for sink in sinks:
+            sink.add(obs)
+        records += 1
+    print("Saving")
+    for sink in sinks:
+        sink.close()
+    # only file-backed sinks (the CsvSinks) have bytes to count; other sinks just need add() and close()
+    written = [sink.f.name for sink in sinks if getattr(sink, 'f', None) is not None]
+    count(records=records, bytes_read=getsize(src), bytes_written=sum(getsize(fname) for fname in written))
+
+
+IDS_CSV = 'idents_expanded.csv'
+COCCI_IDS_CSV = 'identifications-coccinellidae.csv'
+LATEST_IDS_CSV = 'identifications-latest.csv'
+IDS_HEADER = ['observation', 'identifier', 'username', 'date', 'taxon_id', 'taxon', 'rank', 'rank_level', 'previous_taxon_id', 'current', 'disagreement', 'category', 'vision', 'hidden', 'latitude', 'longitude', 'places']
+
+
+# (helper) IDs of Coccinellidae and every taxon below it
+def cocci_taxon_ids(fname='coccinellidae.csv', max_level=30) -> set:
+    with open(fname, newline='') as f:
+        return {int(row['id']) for row in csv.DictReader(f) if float(row['level']) <= max_level}
+
+
+# (helper) Non-self identifications on an observation, as rows of the identifications table
+def id_rows(obs):
+    for id in obs['identifications']:
+        # Ignore IDs that observers are adding as part of their own submission
+        if id['user']['id'] != obs['user']['id']:
+            yield id, [obs['id'],
+                       id['user']['id'],
+                       id['user']['login'],
+                       id['created_at'],
+                       id['taxon']['id'],
+                       id['taxon']['name'],
+                       id['taxon']['rank'],
+                       id['taxon']['rank_level'],
+                       id['previous_observation_taxon_id'],
+                       id['current'],
+                       id['disagreement'],
+                       id['category'],
+                       id['vision'],
+                       id['hidden'],
+                       # GeoJSON points are [longitude, latitude]
+                       obs['geospatial']['geojson']['coordinates'][1],
+                       obs['geospatial']['geojson']['coordinates'][0],
+                       obs['geospatial']['place_ids']]
+
+
+class CsvSink:
+    def __init__(self, fname, header):
+        self.f = open(fname, 'w', newline='')
+        self.writer = csv.writer(self.f)
+        self.writer.writerow(header)
+
+    def close(self) -> None:
+        self.f.close()
+
+
+# Identifications table, optionally limited to IDs of the given taxa. With index=True, the first column
+# is each ID's row number in the unfiltered table (as pandas writes it after slicing the full table).
+class IdsSink(CsvSink):
+    def __init__(self, fname=IDS_CSV, taxon_ids=None, index=False):
+        super().__init__(fname, ([''] if index else []) + IDS_HEADER)
+        self.taxon_ids = taxon_ids
+        self.index = index
+        self.row_num = 0
+
+    def add(self, obs) -> None:
+        for id, row in id_rows(obs):
+            if self.taxon_ids is None or id['taxon']['id'] in self.taxon_ids:
+                self.writer.writerow([self.row_num] + row if self.index else row)
+            self.row_num += 1
+
+
+# Only each identifier's most recent ID on each observation (i.e. genuine revisions replace earlier IDs)
+class LatestIdsSink(CsvSink):
+    def __init__(self, fname=LATEST_IDS_CSV, taxon_ids=None):
+        super().__init__(fname, IDS_HEADER)
+        self.taxon_ids = taxon_ids
+
+    def add(self, obs) -> None:
+        latest = {}
+        for id, row in id_rows(obs):
+            if self.taxon_ids is None or id['taxon']['id'] in self.taxon_ids:
+                # identification IDs increase with creation time
+                if id['user']['id'] not in latest or id['id'] > latest[id['user']['id']][0]:
+                    latest[id['user']['id']] = (id['id'], row)
+        for _, row in latest.values():
+            self.writer.writerow(row)
+
+
+class ObsSink(CsvSink):
+    def __init__(self, fname='observations.csv'):
+        super().__init__(fname, ['obs_id', 'user_id', 'created_on', 'observed_on', 'updated_on', 'quality_grade', 'rank', 'rank_level', 'taxon_id', 'geojson', 'place_ids'])
+
+    def add(self, obs) -> None:
+        self.writer.writerow([obs['id'],
+                              obs['user']['id'],
+                              obs['created_at'],
+                              obs['observed_on'],
+                              obs['updated_at'],
+                              obs['quality_grade'],
+                              obs['taxon']['rank'],
+                              obs['taxon']['rank_level'],
+                              obs['taxon']['id'],
+                              obs['geospatial']['geojson'],
+                              obs['geospatial']['place_ids']])
+
+
+@instrumented()
 def ids_to_csv():
-    print("Loading file")
-    observations = jload('observations/obs.json')
-
-    with open('idents_expanded.csv', 'w', newline='') as f:
-        writer = csv.writer(f)
-        print("Scanning")
-        writer.writerow(['observation', 'identifier', 'username', 'date', 'taxon_id', 'taxon', 'rank', 'rank_level', 'previous_taxon_id', 'current', 'disagreement', 'category', 'vision', 'hidden', 'latitude', 'longitude', 'places'])
-        for obs in observations:
-            for id in obs['identifications']:
-                # Ignore IDs that observers are adding as part of their own submission
-                if id['user']['id'] != obs['user']['id']:
-                    writer.writerow([obs['id'], 
-                                    id['user']['id'],
-                                    id['user']['login'],
-                                    id['created_at'],
-                                    id['taxon']['id'],
-                                    id['taxon']['name'],
-                                    id['taxon']['rank'],
-                                    id['taxon']['rank_level'],
-                                    id['previous_observation_taxon_id'],
-                                    id['current'],
-                                    id['disagreement'],
-                                    id['category'],
-                                    id['vision'],
-                                    id['hidden'],
-                                    obs['geospatial']['geojson']['coordinates'][0],
-                                    obs['geospatial']['geojson']['coordinates'][1],
-                                    obs['geospatial']['place_ids']])
-        print("Saving")
+    export_all([IdsSink()])
 
 
 def obs_to_csv():
-    print("Loading file")
-    observations = jload('observations/obs.json')
-    with open('observations.csv', 'w', newline='') as f:
-        writer = csv.writer(f)
-        print("Scanning")
-        writer.writerow(['obs_id', 'user_id', 'created_on', 'observed_on', 'updated_on', 'quality_grade', 'rank', 'rank_level', 'taxon_id', 'geojson', 'place_ids'])
-        for obs in observations:
-            writer.writerow([obs['id'], 
-                            obs['user']['id'],
-                            obs['created_at'],
-                            obs['observed_on'],
-                            obs['updated_at'],
-                            obs['quality_grade'],
-                            obs['taxon']['rank'],
-                            obs['taxon']['rank_level'],
-                            obs['taxon']['id'],
-                            obs['geospatial']['geojson'],
-                            obs['geospatial']['place_ids']])
-        print("Saving")
+    export_all([ObsSink()])
+
+
+# Typed columnar export: observations, identifications, taxa and users as Parquet tables under `dest`, with
+# native timestamps (UTC), list columns (place_ids, ancestor_ids) and a nested {lon, lat} geometry column.
+# Observations and identifications are partitioned by year created, and read back with load_table().
+PARQUET_DIR = 'parquet'
+
+def export_parquet(src='observations', dest=PARQUET_DIR, batch_size=50_000):
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+    from obsstore import user_key_files
+
+    user_files = user_key_files(src)
+    point = pa.struct([('lon', pa.float64()), ('lat', pa.float64())])
+    utc = pa.timestamp('us', tz='UTC')
+    obs_schema = pa.schema([('id', pa.int64()), ('user_id', pa.int64()), ('created_at', utc), ('observed_on', pa.date32()),
+                            ('updated_at', utc), ('quality_grade', pa.string()), ('taxon_id', pa.int64()), ('rank', pa.string()),
+                            ('rank_level', pa.float32()), ('num_photos', pa.int16()), ('geometry', point),
+                            ('positional_accuracy', pa.int32()), ('obscured', pa.bool_()), ('place_ids', pa.list_(pa.int64())),
+                            ('place_guess', pa.string()), ('year', pa.int16())])
+    ids_schema = pa.schema([('id', pa.int64()), ('observation', pa.int64()), ('identifier', pa.int64()), ('username', pa.string()),
+                            ('created_at', utc), ('taxon_id', pa.int64()), ('taxon', pa.string()), ('rank', pa.string()),
+                            ('rank_level', pa.float32()), ('previous_taxon_id', pa.int64()), ('current', pa.bool_()),
+                            ('disagreement', pa.bool_()), ('category', pa.string()), ('vision', pa.bool_()), ('hidden', pa.bool_()),
+                            ('own_observation', pa.bool_()), ('year', pa.int16())])
+
+    # (helper) column lists -> typed table; timestamps are parsed per batch, naive ones taken as UTC
+    def to_table(cols, schema):
+        for name in cols:
+            if schema.field(name).type == utc:
+                cols[name] = pd.to_datetime(pd.Series(cols[name], dtype=object), utc=True, format='ISO8601')
+        cols['year'] = cols['created_at'].dt.year
+        if 'observed_on' in cols:
+            cols['observed_on'] = pd.to_datetime(pd.Series(cols['observed_on'], dtype=object), errors='coerce').dt.date
+        return pa.Table.from_pandas(pd.DataFrame(cols), schema=schema, preserve_index=False)
+
+    def write(cols, schema, table_name, batch_num):
+        ds.write_dataset(to_table(cols, schema), f"{dest}/{table_name}", format='parquet',
+                         partitioning=ds.partitioning(pa.schema([('year', pa.int16())]), flavor='hive'),
+                         basename_template=f"part-{batch_num}-{{i}}.parquet", existing_data_behavior='overwrite_or_ignore')
+
+    for table_name in ('observations', 'identifications'):
+        if exists(f"{dest}/{table_name}"):
+            rmtree(f"{dest}/{table_name}")
+
+    print("Scanning observations")
+    obs_cols = defaultdict(list)
+    ids_cols = defaultdict(list)
+    observers, identifiers = set(), set()
+    batch_num = 0
+    for obs in iter_json_array(src + '/obs.json'):
+        observers.add(obs['user']['id'])
+        identifiers.update(ident['user']['id'] for ident in obs['identifications'] if ident['user']['id'] != obs['user']['id'])
+        geo = obs['geospatial']
+        coords = geo.get('geojson', {}).get('coordinates') if geo.get('geojson') else None
+        for name, value in (('id', obs['id']), ('user_id', obs['user']['id']), ('created_at', obs['created_at']),
+                            ('observed_on', obs.get('observed_on')), ('updated_at', obs.get('updated_at')),
+                            ('quality_grade', obs.get('quality_grade')), ('taxon_id', obs['taxon']['id']),
+                            ('rank', obs['taxon']['rank']), ('rank_level', obs['taxon']['rank_level']),
+                            ('num_photos', obs.get('num_photos')),
+                            ('geometry', dict(lon=coords[0], lat=coords[1]) if coords else None),
+                            ('positional_accuracy', geo.get('positional_accuracy')), ('obscured', geo.get('obscured')),
+                            ('place_ids', geo.get('place_ids')), ('place_guess', geo.get('place_guess'))):
+            obs_cols[name].append(value)
+        for ident in obs['identifications']:
+            for name, value in (('id', ident['id']), ('observation', obs['id']), ('identifier', ident['user']['id']),
+                                ('username', ident['user']['login']), ('created_at', ident['created_at']),
+                                ('taxon_id', ident['taxon']['id']), ('taxon', ident['taxon']['name']),
+                                ('rank', ident['taxon']['rank']), ('rank_level', ident['taxon']['rank_level']),
+                                ('previous_taxon_id', ident.get('previous_observation_taxon_id')),
+                                ('current', ident.get('current')), ('disagreement', ident.get('disagreement')),
+                                ('category', ident.get('category')), ('vision', ident.get('vision')),
+                                ('hidden', ident.get('hidden')), ('own_observation', ident['user']['id'] == obs['user']['id'])):
+                ids_cols[name].append(value)
+        if len(obs_cols['id']) >= batch_size:
+            write(obs_cols, obs_schema, 'observations', batch_num)
+            write(ids_cols, ids_schema, 'identifications', batch_num)
+            obs_cols.clear()
+            ids_cols.clear()
+            batch_num += 1
+    if obs_cols:
+        write(obs_cols, obs_schema, 'observations', batch_num)
+        write(ids_cols, ids_schema, 'identifications', batch_num)
+
+    print("Writing taxa")
+    taxa = jload(src + '/taxa.json')
+    pq.write_table(pa.Table.from_pylist([dict(id=t['id'], name=t.get('name'), common=t.get('preferred_common_name'),
+                                              rank=t.get('rank'), rank_level=t.get('rank_level'),
+                                              parent_id=t['ancestor_ids'][-2] if len(t.get('ancestor_ids') or []) > 1 else None,
+                                              ancestor_ids=t.get('ancestor_ids'), synonyms=t.get('current_synonymous_taxon_ids'),
+                                              is_active=t.get('is_active'), obs_worldwide=t.get('observations_count'),
+                                              num_species=t.get('complete_species_count'))
+                                         for t in taxa.values()],
+                                        schema=pa.schema([('id', pa.int64()), ('name', pa.string()), ('common', pa.string()),
+                                                          ('rank', pa.string()), ('rank_level', pa.float32()), ('parent_id', pa.int64()),
+                                                          ('ancestor_ids', pa.list_(pa.int64())), ('synonyms', pa.list_(pa.int64())),
+                                                          ('is_active', pa.bool_()), ('obs_worldwide', pa.int64()),
+                                                          ('num_species', pa.int64())])),
+                   f"{dest}/taxa.parquet")
+
+    # roles come from the observations, since a merged users.json no longer says who observed and who identified
+    print("Writing users")
+    users = {}
+    for fname in sorted(set(user_files.values())):
+        users.update(jload(fname))
+    users = pd.DataFrame(list(users.values()))
+    users['is_observer'] = users['id'].isin(observers)
+    users['is_identifier'] = users['id'].isin(identifiers)
+    users['created_at'] = pd.to_datetime(users['created_at'], utc=True, format='ISO8601')
+    pq.write_table(pa.Table.from_pandas(users, preserve_index=False), f"{dest}/users.parquet")
+    print("Saved to", dest)
+
+
+# Reads one table written by export_parquet, touching only the requested columns (and, for the partitioned
+# tables, only the partitions matching `filters`, e.g. [('year', '>=', 2020)])
+def load_table(name, columns=None, filters=None, src=PARQUET_DIR) -> pd.DataFrame:
+    import pyarrow.parquet as pq
+    path = f"{src}/{name}" if name in ('observations', 'identifications') else f"{src}/{name}.parquet"
+    return pq.read_table(path, columns=columns, filters=filters).to_pandas()
 
 
 # ids_to_csv()
 
 
 def count_objects():
+    import pandas as pd
     # Primary datasets:
     # OBSERVATIONS: 
     print(len(jload('observations/obs.json')), "total observations of Coccinellidae downloaded")
@@ -166,103 +322,154 @@ def count_objects():
     # 'coccinellidae.csv' = worldwide taxa
     # 'identifications.csv' = total identifiers
 
-count_objects()
-
-
-# this will take a sec
-def build_stats_table(ids, identifier_stats):
-    # acts on each row of the de-duplicated ids
-    def generate_stats(row):
-        rank = row['rank']
-        if rank not in identifier_stats.columns:
-            rank = 'species'
-        identifier = identifier_stats.loc[row['identifier']]
-        identifier['username'] = row['username']
-        identifier[rank] += 1
-        identifier['total'] += 1
-        identifier_stats.loc[row['identifier']] = identifier
-    #     print(identifier_stats.loc[row['identifier']])
-
-    # acts on each row of identifier_stats
-    def generate_proportions(row):
-        try:
-            row['frac_species'] = row['species']/row['total']
-            row['frac_genus'] = row['genus']/row['total']
-            row['frac_tribe'] = row['tribe']/row['total']
-            row['frac_subfamily'] = row['subfamily']/row['total']
-            row['frac_family'] = row['family']/row['total']
-        except ZeroDivisionError:
-            print("Error processing", row.name, row['username'], "- total is 0")
-            identifier_stats.to_csv('stats.csv')
-            exit()
-        return row
 
+STAT_RANKS = ['species', 'genus', 'tribe', 'subfamily', 'family']
+
+# Counts each identifier's IDs at each rank, with each rank's share of their total.
+# Everything is done as whole-array operations: one factorize, one bincount for the identifier x rank matrix.
+def identifier_stats_table(ids) -> pd.DataFrame:
+    import numpy as np
+    import pandas as pd
     # for calculating who's the most prolific, we want each observation to count just once per identifier
     # keep the most recent ID for its rank, in case of genuine revisions
     print("Sorting by date...")
     ids_nodup = ids.sort_values(by='date')
     print("Dropping duplicates...")
     ids_nodup.drop_duplicates(subset=['identifier', 'observation'], keep='last', ignore_index=True, inplace=True)
-    # print(ids_nodup[34728])
-    # print(identifier_stats.loc[34728])
-    
-    print("Counting...")
-    # use ids array to update the counts
-    ids_nodup.apply(generate_stats, axis='columns')
-
-    # add proportions
-    identifier_stats = identifier_stats.apply(generate_proportions, axis='columns')
 
+    print("Counting...")
+    # identifiers are numbered in order of first appearance, same as ids_nodup['identifier'].unique()
+    identifier_codes, identifier_ids = pd.factorize(ids_nodup['identifier'])
+    # roll subspecies, complex, form etc. into species
+    rank_codes = pd.Categorical(ids_nodup['rank'], categories=STAT_RANKS).codes
+    rank_codes = np.where(rank_codes < 0, 0, rank_codes)
+    counts = np.bincount(identifier_codes * len(STAT_RANKS) + rank_codes, minlength=len(identifier_ids) * len(STAT_RANKS))
+    counts = counts.reshape(len(identifier_ids), len(STAT_RANKS))
+    totals = counts.sum(axis=1)
+
+    identifier_stats = pd.DataFrame(index=pd.Index(identifier_ids, name='identifier'))
+    # username as of each identifier's latest ID
+    identifier_stats['username'] = ids_nodup.groupby(identifier_codes)['username'].last().to_numpy()
+    identifier_stats['total'] = totals
+    for i, rank in enumerate(STAT_RANKS):
+        identifier_stats['frac_' + rank] = counts[:, i] / totals
+        identifier_stats[rank] = counts[:, i]
     identifier_stats.sort_values(by='total', ascending=False, inplace=True)
-    identifier_stats['total'] = identifier_stats['total'].astype(int)
-    identifier_stats['species'] = identifier_stats['species'].astype(int)
-    identifier_stats['genus'] = identifier_stats['genus'].astype(int)
-    identifier_stats['tribe'] = identifier_stats['tribe'].astype(int)
-    identifier_stats['subfamily'] = identifier_stats['subfamily'].astype(int)
-    identifier_stats['family'] = identifier_stats['family'].astype(int)
+    return identifier_stats
+
 
+@instrumented()
+def build_stats_table(ids, fname='stats.csv') -> pd.DataFrame:
+    identifier_stats = identifier_stats_table(ids)
     # export
-    identifier_stats.to_csv('stats.csv')
+    identifier_stats.to_csv(fname)
+    count(records=len(ids), bytes_written=getsize(fname))
+    return identifier_stats
 
 
-def cocci_id_stats_to_csv():
-    ids = pd.read_csv('identifications.csv')
-    taxonomy = pd.read_csv('coccinellidae.csv')
+# Reads the latest-ID table written by export_all(), which is already limited to Coccinellidae and below
+# and keeps only each identifier's most recent ID per observation
+def cocci_id_stats_to_csv(fname=LATEST_IDS_CSV):
+    import pandas as pd
+    build_stats_table(pd.read_csv(fname))
 
-    # only look at identifiers who're working within Coccinellidae
-    cocci_fam_and_below = taxonomy[taxonomy.level <= 30]
-    orig_len = len(ids)
-    ids = ids.loc[ids['taxon_id'].isin(cocci_fam_and_below['id'])]
-    print(orig_len - len(ids), "extraneous identifiers removed")
 
-    ids_nodup = ids.sort_values(by='date')
-    ids_nodup.drop_duplicates(subset=['identifier', 'observation'], keep='last', ignore_index=True, inplace=True)
+# cocci_id_stats_to_csv()
+
 
-    # initialize stats array
-    identifier_ids = ids_nodup['identifier'].unique()
-    columns = ['total', 'frac_species', 'species', 'frac_genus', 'genus', 'frac_tribe', 'tribe', 'frac_subfamily', 'subfamily', 'frac_family', 'family']
-    shape = (len(identifier_ids), len(columns))
-    identifier_stats = pd.DataFrame(np.zeros(shape), index=identifier_ids, columns=columns)
-    identifier_stats.insert(0, 'username', 'n/a')
+# (helper) Replaces the rows of an ID-ordered table (observation ID in the first column) belonging to `changed`
+# observations with the rows in new_fname, keeping observation order. Returns the rows that were removed.
+def patch_csv(fname, new_fname, changed) -> list:
+    removed = []
+    def kept(reader):
+        for row in reader:
+            if int(row[0]) in changed:
+                removed.append(row)
+            else:
+                yield row
+
+    with open(fname, newline='') as old, open(new_fname, newline='') as new, open(fname + '.tmp', 'w', newline='') as out:
+        old_rows, new_rows = csv.reader(old), csv.reader(new)
+        writer = csv.writer(out)
+        writer.writerow(next(old_rows))
+        next(new_rows)
+        writer.writerows(heapq.merge(kept(old_rows), new_rows, key=lambda row: int(row[0])))
+    replace(fname + '.tmp', fname)
+    remove(new_fname)
+    return removed
+
+
+# (helper) Rewrites the Coccinellidae-only table from the full identifications table, keeping its row numbers
+def filter_ids_csv(taxon_ids, src=IDS_CSV, fname=COCCI_IDS_CSV) -> None:
+    with open(src, newline='') as f, open(fname, 'w', newline='') as out:
+        reader = csv.reader(f)
+        writer = csv.writer(out)
+        writer.writerow([''] + next(reader))
+        for row_num, row in enumerate(reader):
+            if int(row[4]) in taxon_ids:
+                writer.writerow([row_num] + row)
+
+
+# Applies the observations changed by import.sync_obs() (queued in '<store>/.sync', saved as '<store>/delta.json')
+# to the derived tables: only their rows are replaced in the identification tables, and only the identifiers
+# whose latest IDs were touched get their stats.csv rows recomputed
+@instrumented()
+def sync_derived(store='observations', stats_fname='stats.csv'):
+    import pandas as pd
+    state = jload(f"{store}/.sync")
+    if not state['pending']:
+        print("Nothing to sync")
+        return
+    delta = jload(store + '/delta.json')
+    changed = {obs['id'] for obs in delta}
+    cocci = cocci_taxon_ids()
+
+    print(f"Patching rows for {len(changed)} observations...")
+    sinks = [IdsSink(IDS_CSV + '.new'), LatestIdsSink(LATEST_IDS_CSV + '.new', taxon_ids=cocci)]
+    for obs in delta:
+        for sink in sinks:
+            sink.add(obs)
+    for sink in sinks:
+        sink.close()
+    patch_csv(IDS_CSV, IDS_CSV + '.new', changed)
+    filter_ids_csv(cocci)
+    removed = patch_csv(LATEST_IDS_CSV, LATEST_IDS_CSV + '.new', changed)
+
+    # identifiers with a latest ID on a changed observation, before or after the change
+    affected = {int(row[1]) for row in removed}
+    for obs in delta:
+        affected.update(id['user']['id'] for id in obs['identifications'] if id['user']['id'] != obs['user']['id'])
+    print(f"Recomputing stats for {len(affected)} identifiers...")
+    latest = pd.read_csv(LATEST_IDS_CSV, usecols=['observation', 'identifier', 'username', 'date', 'rank'])
+    updated = identifier_stats_table(latest[latest['identifier'].isin(affected)])
+    identifier_stats = pd.read_csv(stats_fname, index_col='identifier')
+    identifier_stats = pd.concat([identifier_stats[~identifier_stats.index.isin(affected)], updated])
+    identifier_stats.sort_values(by='total', ascending=False, inplace=True)
+    identifier_stats.to_csv(stats_fname)
 
-    build_stats_table(ids_nodup, identifier_stats)
+    state['pending'] = []
+    write_small(state, f"{store}/.sync")
+    remove(store + '/delta.json')
 
 
-# cocci_id_stats_to_csv()
 
 
+# 2022-09-30, 6 months after final obs creation date
+# Identifications as they stood at the cutoff (that day included): later IDs dropped, and 'current' meaning
+# current then. With a taxonomy.TaxonomyIndex, each row also gets its observation's community taxon at the cutoff.
+# For many cutoffs, build one snapshots.SnapshotIndex and query it directly.
+def date_cutoff(cutoff='2022-09-30', src='observations/obs.json', taxonomy=None):
+    from snapshots import SnapshotIndex
+    snapshots = SnapshotIndex.from_obs(src, taxonomy)
+    ids = snapshots.identifications_as_of(cutoff)
+    if taxonomy is not None:
+        ids['community_taxon_id'] = ids['observation'].map(snapshots.community_taxon_as_of(cutoff)).astype('Int64')
+    return ids
 
 
-# 2022-09-31, 6 months after final obs creation date
-def date_cutoff(cutoff='2022-09-31'):
-    with open('import final/obs.json') as f:
-        observations = json.load(f)
-    for obs in observations:
-        non_id = 'comments, flags, votes'.split(", ")
-        for log in obs[non_id]:
-            if 'created_at' in log and log['created_at'][:10] > cutoff:
-                del log
-        for id in reversed(obs['identifications']):
-            if id['created_at'][:10] > cutoff:
-                # TODO
-                pass
+if __name__ == '__main__':
+    import numpy as np
+    import pandas as pd
+    from rich.traceback import install
+    install(show_locals=True, suppress=[pd, np])
+    count_objects()
@@ -0,0 +1,179 @@
+import numpy as np
+import pandas as pd
+
+# Identifier profiles: how many IDs every identifier made in each ID category, at each rank, agreeing or
+# disagreeing with the observation's previous taxon, and in each year. One pass over the identifications (as loaded
+# by loader.load_identifications()) counts every combination of those at once, for all identifiers, into a sparse
+# cube of the non-empty cells. Tables, shares and selections are then a bincount over the cells, so "top 50" is
+# just a slice of identifiers taken when displaying, not a limit on what gets counted.
+#
+#   PROFILES = IdentifierProfiles.from_ids(ALL_IDS, user_totals=USER_TOTALS)
+#   PROFILES.proportions(PROFILES.top(50))                      the notebooks' PROPORTIONS table
+#   PROFILES.table('rank', PROFILES.rank_band(11, 20), years=[2021, 2022])
+#   PROFILES.where(min_ids=100, below={'species': 0.75})        100+ IDs and under 75% at species
+#
+# Identifiers are numbered by leaderboard rank (their position in stats.csv, when given), so identifier i in the
+# cube is leaderboard #i+1 and rank bands are slices.
+
+CATEGORIES = ['leading', 'improving', 'supporting', 'maverick']
+RANKS = ['family', 'subfamily', 'tribe', 'genus', 'species', 'subspecies', 'complex', 'form']
+AGREEMENT = ['agrees', 'disagrees']
+DIMENSIONS = ['category', 'rank', 'disagreement', 'year']
+UNKNOWN = 'unknown'
+
+
+# (helper) Values -> codes into labels: the expected values first, then any others seen, then UNKNOWN for missing ones
+def dimension_codes(values, expected):
+    values = pd.Series(values, copy=False)
+    missing = values.isna().to_numpy()
+    labels = list(expected) + sorted(set(values[~missing].unique()) - set(expected))
+    codes = pd.Categorical(values, categories=labels).codes.astype(np.int64)
+    if missing.any():
+        codes[missing] = len(labels)
+        labels.append(UNKNOWN)
+    return codes, labels
+
+
+class IdentifierProfiles:
+    def __init__(self, cells: pd.DataFrame, labels: dict, identifiers: pd.DataFrame):
+        # cells: one row per non-empty (identifier, category, rank, disagreement, year), with codes into `labels`
+        # and the number of IDs in 'ids'
+        self.cells = cells
+        self.labels = labels
+        # identifiers: id, username and total IDs, in leaderboard order (row i = rank i+1)
+        self.identifiers = identifiers
+        self.codes = pd.Series(np.arange(len(identifiers)), index=identifiers['identifier'])
+
+    @classmethod
+    def from_ids(cls, ids, user_totals=None):
+        identifier_codes, identifier_ids = pd.factorize(ids['identifier'])
+        times = ids['datetime'] if 'datetime' in ids.columns else pd.to_datetime(ids['date'], utc=True, format='ISO8601')
+        # disagreement comes as bools, or as their strings once a notebook has cast the column with astype(str)
+        disagreement = ids['disagreement'].map({True: 'disagrees', False: 'agrees', 'True': 'disagrees', 'False': 'agrees'})
+        columns = dict(category=dimension_codes(ids['category'], CATEGORIES),
+                       rank=dimension_codes(ids['rank'], RANKS),
+                       disagreement=dimension_codes(disagreement, AGREEMENT),
+                       year=dimension_codes(times.dt.year.astype('Int64'), [int(year) for year in sorted(times.dt.year.dropna().unique())]))
+        labels = {dim: dim_labels for dim, (_, dim_labels) in columns.items()}
+        shape = [len(identifier_ids)] + [len(labels[dim]) for dim in DIMENSIONS]
+
+        # every ID's cell as one int64, counted with a single unique()
+        keys = np.ravel_multi_index([identifier_codes] + [columns[dim][0] for dim in DIMENSIONS], shape)
+        keys, ids_per_cell = np.unique(keys, return_counts=True)
+        cell_codes = np.unravel_index(keys, shape)
+        totals = np.bincount(cell_codes[0], weights=ids_per_cell, minlength=len(identifier_ids)).astype(np.int64)
+
+        # Leaderboard: the order of stats.csv if given (identifiers missing from it come after, by total), else by total
+        by_total = np.argsort(-totals, kind='stable')
+        if user_totals is None:
+            order = by_total
+            usernames = ids.groupby(identifier_codes)['username'].last().to_numpy()
+        else:
+            positions = pd.Index(user_totals.index).get_indexer(identifier_ids).astype(np.int64)
+            positions[positions < 0] = len(user_totals) + np.argsort(by_total)[positions < 0]
+            order = np.argsort(positions, kind='stable')
+            usernames = user_totals['username'].reindex(identifier_ids).to_numpy()
+            unlisted = pd.isna(usernames)
+            if unlisted.any():
+                usernames[unlisted] = ids.groupby(identifier_codes)['username'].last().to_numpy()[unlisted]
+        new_code = np.empty_like(order)
+        new_code[order] = np.arange(len(order))
+
+        cells = pd.DataFrame(dict(identifier=new_code[cell_codes[0]].astype(np.int32),
+                                  **{dim: codes.astype(np.int16) for dim, codes in zip(DIMENSIONS, cell_codes[1:])},
+                                  ids=ids_per_cell.astype(np.int64)))
+        cells = cells.sort_values(['identifier'] + DIMENSIONS, ignore_index=True)
+        identifiers = pd.DataFrame(dict(identifier=identifier_ids[order], username=usernames[order], total=totals[order]))
+        return cls(cells, labels, identifiers)
+
+    def save(self, fname='profiles.pkl') -> None:
+        pd.to_pickle(dict(cells=self.cells, labels=self.labels, identifiers=self.identifiers), fname)
+
+    @classmethod
+    def load(cls, fname='profiles.pkl'):
+        return cls(**pd.read_pickle(fname))
+
+    # Leaderboard rank (1 = most IDs) of each identifier ID, <NA> for identifiers with no IDs here
+    def leaderboard_rank(self, identifier_ids) -> pd.Series:
+        ranks = self.codes.reindex(identifier_ids).to_numpy() + 1
+        return pd.Series(ranks, index=getattr(identifier_ids, 'index', None), name='identifier_rank').astype('Int64')
+
+    # Identifier IDs of the top n, in leaderboard order
+    def top(self, n) -> np.ndarray:
+        return self.identifiers['identifier'].to_numpy()[:n]
+
+    # Identifier IDs ranked first to last (inclusive, counting from 1), e.g. rank_band(11, 20)
+    def rank_band(self, first, last) -> np.ndarray:
+        return self.identifiers['identifier'].to_numpy()[first - 1:last]
+
+    # (helper) cells of these identifiers (all if None) and years (all if None)
+    def select_cells(self, identifiers=None, years=None) -> pd.DataFrame:
+        cells = self.cells
+        if identifiers is not None:
+            cells = cells[np.isin(cells['identifier'].to_numpy(), self.codes.reindex(identifiers).dropna().to_numpy())]
+        if years is not None:
+            year_codes = [self.labels['year'].index(year) for year in years if year in self.labels['year']]
+            cells = cells[np.isin(cells['year'].to_numpy(), year_codes)]
+        return cells
+
+    # IDs per identifier x value of one dimension, in leaderboard order (identifiers given keep their order)
+    def table(self, dimension, identifiers=None, years=None, normalize=False) -> pd.DataFrame:
+        cells = self.select_cells(identifiers, years)
+        labels = self.labels[dimension]
+        counts = np.bincount(cells['identifier'].to_numpy().astype(np.int64) * len(labels) + cells[dimension].to_numpy(),
+                             weights=cells['ids'].to_numpy(), minlength=len(self.identifiers) * len(labels))
+        table = pd.DataFrame(counts.reshape(len(self.identifiers), len(labels)).astype(np.int64),
+                             index=pd.Index(self.identifiers['identifier'], name='identifier'), columns=labels)
+        if identifiers is not None:
+            table = table.reindex(identifiers, fill_value=0)
+        if normalize:
+            table = table.div(table.sum(axis=1).replace(0, np.nan), axis=0)
+        return table
+
+    # (helper) label -> (dimension, column); ambiguous labels like 'unknown' are given as 'dimension:label'
+    def find_label(self, label):
+        dim, sep, value = str(label).partition(':')
+        if sep:
+            for column in self.labels.get(dim, []):
+                if str(column) == value:
+                    return dim, column
+            raise KeyError(f"no {dim} {value!r} in these profiles")
+        matches = [dim for dim in DIMENSIONS if label in self.labels[dim]]
+        if len(matches) != 1:
+            raise KeyError(f"{label!r} names {'no' if not matches else 'more than one'} profile column; "
+                           f"use 'dimension:label', e.g. 'rank:{UNKNOWN}'")
+        return matches[0], label
+
+    # Identifier IDs (in leaderboard order) with at least min_ids / at most max_ids IDs, and whose share of IDs
+    # with each label is below/at least the given fraction: where(min_ids=100, below={'species': 0.75})
+    def where(self, min_ids=None, max_ids=None, below=None, above=None) -> np.ndarray:
+        totals = self.identifiers['total'].to_numpy()
+        keep = np.ones(len(totals), dtype=bool)
+        if min_ids is not None:
+            keep &= totals >= min_ids
+        if max_ids is not None:
+            keep &= totals <= max_ids
+        shares = {}
+        for bounds, compare in ((below or {}, np.less), (above or {}, np.greater_equal)):
+            for label, fraction in bounds.items():
+                dim, column = self.find_label(label)
+                if dim not in shares:
+                    shares[dim] = self.table(dim, normalize=True)
+                keep &= compare(shares[dim][column].to_numpy(), fraction)
+        return self.identifiers['identifier'].to_numpy()[keep]
+
+    # One row per identifier with their share of IDs in each category, rank and agreement, laid out as the
+    # PROPORTIONS table of '5 - ID categories'
+    def proportions(self, identifiers=None, years=None) -> pd.DataFrame:
+        if identifiers is None:
+            identifiers = self.identifiers['identifier'].to_numpy()
+        info = self.identifiers.set_index('identifier').loc[identifiers]
+        shares = [self.table(dim, identifiers, years, normalize=True) for dim in ('category', 'rank', 'disagreement')]
+        # the notebook's columns are there even when nothing is unknown
+        category = shares[0].rename(columns={UNKNOWN: 'category unknown'})
+        category['category unknown'] = category.get('category unknown', 0.0)
+        agreement = shares[2].rename(columns={UNKNOWN: 'disagree unknown'})
+        agreement['disagree unknown'] = agreement.get('disagree unknown', 0.0)
+        table = pd.DataFrame(dict(username=info['username'], identifier_rank=self.leaderboard_rank(identifiers).to_numpy(),
+                                  num_IDs=self.table('rank', identifiers, years).sum(axis=1)))
+        return pd.concat([table, category, shares[1].drop(columns=[UNKNOWN], errors='ignore'), agreement], axis=1)
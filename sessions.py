@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+
+# Identification sessions: each identifier's IDs, in time order, split wherever they pause for longer than `gap`
+# (or, with gap=None, split by calendar day as in the original sessions.csv). Works on identifications as loaded
+# by loader.load_identifications(), in one sorted pass over all identifiers at once.
+
+
+def build_sessions(ids, gap='30min', user_totals=None) -> pd.DataFrame:
+    ids = ids.sort_values(['identifier', 'datetime'], kind='stable')
+    users = ids['identifier'].to_numpy()
+    times = ids['datetime'].to_numpy()
+    if len(ids) == 0:
+        return pd.DataFrame(columns=['user', 'username', 'user_leaderboard', 'date', 'start', 'end', 'minutes', 'ids', 'ids_per_minute'])
+
+    # A session starts at each ID whose identifier differs from the one before, or which comes after a long pause
+    # (or on a new day)
+    starts_session = np.ones(len(ids), dtype=bool)
+    if gap is None:
+        days = times.astype('datetime64[D]')
+        starts_session[1:] = (users[1:] != users[:-1]) | (days[1:] != days[:-1])
+    else:
+        starts_session[1:] = (users[1:] != users[:-1]) | (np.diff(times) > pd.Timedelta(gap).to_timedelta64())
+    starts = np.flatnonzero(starts_session)
+    ends = np.append(starts[1:], len(ids)) - 1
+
+    sessions = pd.DataFrame(dict(user=users[starts], start=times[starts], end=times[ends], ids=ends - starts + 1))
+    sessions['date'] = sessions['start'].dt.date
+    sessions['minutes'] = (sessions['end'] - sessions['start']) / pd.Timedelta(minutes=1)
+    # sessions under a minute long count as one minute, so single-ID sessions don't divide by zero
+    sessions['ids_per_minute'] = sessions['ids'] / sessions['minutes'].clip(lower=1)
+
+    # Leaderboard rank = position in stats.csv (sorted by total IDs), or by IDs in this table if not given
+    if user_totals is None:
+        totals = ids['identifier'].value_counts()
+        usernames = ids.groupby('identifier')['username'].last()
+    else:
+        totals = user_totals['total']
+        usernames = user_totals['username']
+    ranking = pd.Series(np.arange(1, len(totals) + 1), index=totals.index)
+    sessions['user_leaderboard'] = ranking.reindex(sessions['user']).astype('Int64').to_numpy()
+    sessions['username'] = usernames.reindex(sessions['user']).to_numpy()
+
+    sessions = sessions[['user', 'username', 'user_leaderboard', 'date', 'start', 'end', 'minutes', 'ids', 'ids_per_minute']]
+    sessions = sessions.sort_values('ids', ascending=False).reset_index(drop=True)
+    sessions.index.rename('session_leaderboard', inplace=True)
+    return sessions
+
+
+# Daily sessions in the same layout as the checked-in sessions.csv
+def sessions_to_csv(ids, user_totals, fname='sessions.csv', gap=None) -> None:
+    sessions = build_sessions(ids, gap=gap, user_totals=user_totals)
+    columns = ['user', 'username', 'user_leaderboard', 'date', 'ids'] if gap is None else sessions.columns
+    sessions[columns].to_csv(fname)
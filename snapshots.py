@@ -0,0 +1,206 @@
+import numpy as np
+import pandas as pd
+
+from jsonstream import iter_json_array
+
+# As-of snapshots: the state of every observation at a past date, without look-ahead. One pass over the condensed
+# observations builds a flat event table (identifications, comments, flags, votes), sorted by observation and
+# then time, and, given a taxonomy, the community taxon after each identification. Every query after that is a
+# binary search into those tables, so sweeping many cutoffs for a time series costs one search per cutoff,
+# not one rewrite of obs.json per date.
+#
+#   SNAPSHOTS = SnapshotIndex.from_obs('observations/obs.json', TaxonomyIndex.from_taxa_json())
+#   SNAPSHOTS.identifications_as_of('2022-09-30')
+#   SNAPSHOTS.community_taxon_sweep(pd.date_range('2020-01-01', '2022-09-30', freq='MS'))
+#
+# Cutoffs given as dates include the whole day (UTC). The API doesn't record when an ID was withdrawn, or hidden,
+# so a withdrawn ID counts as current until its identifier adds another one, and hidden IDs count as hidden
+# from the start.
+
+EVENT_KINDS = ['identification', 'comment', 'flag', 'vote']
+COMMUNITY_SCORE = 2 / 3   # share of IDs a taxon needs to be the community taxon (with at least two IDs)
+TIME_BITS = 34            # seconds since 1970 fit in 34 bits until the year 2514
+
+
+# (helper) Cutoff -> seconds since 1970 (UTC), with a bare date meaning the end of that day
+def cutoff_seconds(cutoff) -> int:
+    ts = pd.Timestamp(cutoff)
+    if ts.tzinfo is None:
+        ts = ts.tz_localize('UTC')
+    if isinstance(cutoff, str) and len(cutoff) == 10:
+        ts += pd.Timedelta(days=1) - pd.Timedelta(seconds=1)
+    return int(ts.timestamp())
+
+
+# (helper) Indices start[i]:end[i] for every i, concatenated
+def ranges(starts, ends):
+    lengths = ends - starts
+    return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+
+# The community taxon of a set of current IDs, by iNaturalist's rule: the lowest taxon that at least two IDs
+# support and that more than COMMUNITY_SCORE of the IDs agree with. IDs of other branches count against a taxon,
+# as do IDs of its ancestors made as explicit disagreements. Returns -1 if no taxon qualifies.
+def community_taxon(idents, lineage) -> int:
+    lineages = [(set(lineage(taxon_id)) or {taxon_id}, taxon_id, disagreement) for taxon_id, disagreement in idents]
+    best, best_depth = -1, -1
+    for candidate in set().union(*(ancestors for ancestors, _, _ in lineages)):
+        candidate_lineage = set(lineage(candidate))
+        support = against = 0
+        for ancestors, taxon_id, disagreement in lineages:
+            if candidate in ancestors:
+                support += 1
+            elif taxon_id not in candidate_lineage or disagreement:
+                against += 1
+        depth = len(candidate_lineage)
+        if support >= 2 and support / (support + against) > COMMUNITY_SCORE and depth > best_depth:
+            best, best_depth = candidate, depth
+    return best
+
+
+class SnapshotIndex:
+    def __init__(self, events: pd.DataFrame, observations: pd.DataFrame, community=None):
+        # events: one row per identification/comment/flag/vote, sorted by (observation, time)
+        self.events = events
+        # observations: id, user and created time, in ID order
+        self.observations = observations
+        self.obs_ids = observations['id'].to_numpy()
+        self.event_keys = self.keys(events['observation'].to_numpy(), events['seconds'].to_numpy())
+        # community: the community taxon after each change, as (observation, seconds, taxon_id) sorted the same way
+        self.community = community
+        if community is not None:
+            self.community_keys = self.keys(community['observation'].to_numpy(), community['seconds'].to_numpy())
+
+    # observations: a condensed obs.json, or any iterable of condensed observations (e.g. an obsstore.ObsStore).
+    # With a taxonomy.TaxonomyIndex, the community taxon timeline is built too.
+    @classmethod
+    def from_obs(cls, observations='observations/obs.json', taxonomy=None):
+        if isinstance(observations, str):
+            observations = iter_json_array(observations)
+        obs_cols = dict(id=[], user=[], created_at=[])
+        cols = dict(observation=[], kind=[], id=[], user=[], created_at=[], taxon_id=[], category=[],
+                    disagreement=[], current=[], hidden=[])
+        for obs in observations:
+            obs_cols['id'].append(obs['id'])
+            obs_cols['user'].append(obs['user']['id'])
+            obs_cols['created_at'].append(obs['created_at'])
+            for kind in EVENT_KINDS:
+                for event in obs.get(kind + 's') or []:
+                    if not event.get('created_at'):
+                        continue
+                    ident = kind == 'identification'
+                    cols['observation'].append(obs['id'])
+                    cols['kind'].append(kind)
+                    cols['id'].append(event.get('id', -1))
+                    cols['user'].append((event.get('user') or {}).get('id', event.get('user_id', -1)))
+                    cols['created_at'].append(event['created_at'])
+                    cols['taxon_id'].append(event['taxon']['id'] if ident else -1)
+                    cols['category'].append(event.get('category') if ident else None)
+                    cols['disagreement'].append(bool(event.get('disagreement')) if ident else False)
+                    cols['current'].append(bool(event.get('current')) if ident else False)
+                    cols['hidden'].append(bool(event.get('hidden')) if ident else False)
+
+        events = pd.DataFrame(cols)
+        events['kind'] = pd.Categorical(events['kind'], categories=EVENT_KINDS)
+        events['time'] = pd.to_datetime(events.pop('created_at'), utc=True, format='ISO8601').dt.tz_localize(None)
+        events['seconds'] = events['time'].to_numpy().astype('datetime64[s]').astype(np.int64)
+        events = events.sort_values(['observation', 'seconds', 'id'], kind='stable', ignore_index=True)
+        observations = pd.DataFrame(obs_cols).sort_values('id', ignore_index=True)
+        observations['time'] = pd.to_datetime(observations.pop('created_at'), utc=True, format='ISO8601').dt.tz_localize(None)
+        community = None if taxonomy is None else community_timeline(events, taxonomy)
+        return cls(events, observations, community)
+
+    def save(self, fname='observations/snapshots.pkl') -> None:
+        pd.to_pickle(dict(events=self.events, observations=self.observations, community=self.community), fname)
+
+    @classmethod
+    def load(cls, fname='observations/snapshots.pkl'):
+        return cls(**pd.read_pickle(fname))
+
+    # (helper) (observation, seconds) pairs packed into one sortable int64
+    def keys(self, obs_ids, seconds):
+        return (np.searchsorted(self.obs_ids, obs_ids).astype(np.int64) << TIME_BITS) | seconds
+
+    # (helper) for each observation, the position just past its last row at or before the cutoff, and where
+    # its rows start
+    def cut(self, keys, cutoff):
+        codes = np.arange(len(self.obs_ids), dtype=np.int64) << TIME_BITS
+        return np.searchsorted(keys, codes, side='left'), np.searchsorted(keys, codes | cutoff_seconds(cutoff), side='right')
+
+    # Every event (of the given kinds) that had happened by the cutoff
+    def events_as_of(self, cutoff, kinds=None) -> pd.DataFrame:
+        events = self.events.iloc[ranges(*self.cut(self.event_keys, cutoff))]
+        return events if kinds is None else events[events['kind'].isin(kinds)]
+
+    # Identifications made by the cutoff, with 'current' meaning current at the cutoff (not superseded by a later
+    # ID from the same identifier made before it)
+    def identifications_as_of(self, cutoff) -> pd.DataFrame:
+        ids = self.events_as_of(cutoff, ['identification']).drop(columns=['kind'])
+        ids['current'] = ~ids.duplicated(subset=['observation', 'user'], keep='last')
+        return ids.reset_index(drop=True)
+
+    # One observation's events up to the cutoff
+    def observation_as_of(self, obs_id, cutoff) -> pd.DataFrame:
+        pos = int(np.searchsorted(self.obs_ids, obs_id))
+        if pos == len(self.obs_ids) or self.obs_ids[pos] != obs_id:
+            raise KeyError(obs_id)
+        code = pos << TIME_BITS
+        start = np.searchsorted(self.event_keys, code, side='left')
+        end = np.searchsorted(self.event_keys, code | cutoff_seconds(cutoff), side='right')
+        return self.events.iloc[start:end]
+
+    # Community taxon of every observation that existed at the cutoff (<NA> where there wasn't one yet)
+    def community_taxon_as_of(self, cutoff) -> pd.Series:
+        if self.community is None:
+            raise ValueError("this index was built without a taxonomy, so it has no community taxa")
+        starts, ends = self.cut(self.community_keys, cutoff)
+        taxa = np.where(ends > starts, self.community['taxon_id'].to_numpy()[ends - 1], -1)
+        existed = (self.observations['time'] <= pd.Timestamp(cutoff_seconds(cutoff), unit='s')).to_numpy()
+        return pd.Series(taxa[existed], index=pd.Index(self.obs_ids[existed], name='observation'),
+                         name='community_taxon_id').replace(-1, pd.NA).astype('Int64')
+
+    # Community taxa at each cutoff: observations x cutoffs (<NA> before an observation existed or had one)
+    def community_taxon_sweep(self, cutoffs) -> pd.DataFrame:
+        return pd.DataFrame({cutoff: self.community_taxon_as_of(cutoff) for cutoff in cutoffs},
+                            index=pd.Index(self.obs_ids, name='observation'))
+
+    # Running totals of observations and each kind of event at each cutoff
+    def counts_as_of(self, cutoffs) -> pd.DataFrame:
+        seconds = [cutoff_seconds(cutoff) for cutoff in cutoffs]
+        obs_times = np.sort(self.observations['time'].to_numpy().astype('datetime64[s]').astype(np.int64))
+        counts = dict(observations=np.searchsorted(obs_times, seconds, side='right'))
+        for kind in EVENT_KINDS:
+            times = np.sort(self.events.loc[self.events['kind'] == kind, 'seconds'].to_numpy())
+            counts[kind + 's'] = np.searchsorted(times, seconds, side='right')
+        return pd.DataFrame(counts, index=pd.Index(list(cutoffs), name='cutoff'))
+
+
+# (helper) Replays each observation's identifications in time order, recording the community taxon whenever it
+# changes. Hidden IDs supersede their identifier's earlier ID but don't count themselves.
+def community_timeline(events, taxonomy) -> pd.DataFrame:
+    lineages = {}
+    def lineage(taxon_id):
+        if taxon_id not in lineages:
+            lineages[taxon_id] = taxonomy.ancestors(taxon_id)
+        return lineages[taxon_id]
+
+    ids = events[events['kind'] == 'identification']
+    timeline = dict(observation=[], seconds=[], taxon_id=[])
+    current = {}
+    last_obs = last_taxon = None
+    for obs_id, seconds, user, taxon_id, disagreement, hidden in zip(
+            ids['observation'].to_numpy(), ids['seconds'].to_numpy(), ids['user'].to_numpy(),
+            ids['taxon_id'].to_numpy(), ids['disagreement'].to_numpy(), ids['hidden'].to_numpy()):
+        if obs_id != last_obs:
+            current = {}
+            last_obs, last_taxon = obs_id, -1
+        current[user] = None if hidden else (int(taxon_id), bool(disagreement))
+        taxon = community_taxon([ident for ident in current.values() if ident], lineage)
+        if taxon != last_taxon:
+            timeline['observation'].append(obs_id)
+            timeline['seconds'].append(seconds)
+            timeline['taxon_id'].append(taxon)
+            last_taxon = taxon
+    return pd.DataFrame(dict(observation=np.array(timeline['observation'], dtype=np.int64),
+                             seconds=np.array(timeline['seconds'], dtype=np.int64),
+                             taxon_id=np.array(timeline['taxon_id'], dtype=np.int64)))
@@ -0,0 +1,325 @@
+import numpy as np
+import pandas as pd
+
+from snapshots import ranges
+
+# Spatial index over the identifications tables' latitude/longitude columns (as loaded by
+# loader.load_identifications()). Points are bucketed into a grid of cell_deg-degree cells and sorted by cell, so
+# bounding-box and radius queries only look at the rows in the cells they overlap, and then check the exact
+# (haversine) distance. With scikit-learn installed, radius queries use a haversine BallTree instead.
+#
+#   SPATIAL = SpatialIndex(ALL_IDS)
+#   SPATIAL.radius(45.52, -122.68, km=25)                     rows within 25 km, with distance_km
+#   SPATIAL.bbox(south=42, west=-124.6, north=46.3, east=-116.5)
+#   SPATIAL.cluster(eps_km=10, min_samples=4, by='identifier')    DBSCAN per identifier, all at once
+#   SPATIAL.heatmap(precision=4, by='identifier')              IDs per geohash cell (and identifier)
+#
+# Tables exported before process.id_rows() was fixed have latitude and longitude swapped; re-export them
+# (python cli.py export) before indexing.
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = np.pi * EARTH_RADIUS_KM / 180
+CELL_DEG = 0.1
+GEOHASH_CHARS = np.frombuffer(b'0123456789bcdefghjkmnpqrstuvwxyz', dtype=np.uint8)
+PAIR_BUDGET = 5_000_000   # candidate pairs checked at once when clustering
+
+
+# Great-circle distance in km between (arrays of) points
+def haversine(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = (np.radians(x) for x in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+# Geohashes of (arrays of) points, `precision` characters long (4 is about 39 x 20 km, 5 about 5 x 5 km)
+def geohash(lat, lon, precision=5) -> np.ndarray:
+    codes = geohash_codes(np.asarray(lat, dtype=float), np.asarray(lon, dtype=float), precision)
+    shifts = 5 * np.arange(precision - 1, -1, -1, dtype=np.int64)
+    chars = GEOHASH_CHARS[(codes[:, None] >> shifts) & 31]
+    return np.ascontiguousarray(chars).view(f'S{precision}').ravel().astype(str)
+
+
+# (helper) Geohashes as integers: longitude and latitude bits interleaved, longitude first
+def geohash_codes(lat, lon, precision) -> np.ndarray:
+    bits = 5 * precision
+    lon_bits, lat_bits = (bits + 1) // 2, bits // 2
+    lat_i = np.clip(((lat + 90) / 180 * 2 ** lat_bits).astype(np.int64), 0, 2 ** lat_bits - 1)
+    lon_i = np.clip(((lon + 180) / 360 * 2 ** lon_bits).astype(np.int64), 0, 2 ** lon_bits - 1)
+    codes = np.zeros(len(lat_i), dtype=np.int64)
+    for bit in range(bits):
+        # even bits (from the top) are longitude, odd ones latitude
+        source, shift = (lon_i, lon_bits - 1 - bit // 2) if bit % 2 == 0 else (lat_i, lat_bits - 1 - bit // 2)
+        codes = (codes << 1) | ((source >> shift) & 1)
+    return codes
+
+
+# (helper) Centre of each geohash code's cell
+def geohash_centres(codes, precision):
+    bits = 5 * precision
+    lon_bits, lat_bits = (bits + 1) // 2, bits // 2
+    lat_i = np.zeros(len(codes), dtype=np.int64)
+    lon_i = np.zeros(len(codes), dtype=np.int64)
+    for bit in range(bits):
+        value = (codes >> (bits - 1 - bit)) & 1
+        if bit % 2 == 0:
+            lon_i = (lon_i << 1) | value
+        else:
+            lat_i = (lat_i << 1) | value
+    return (lat_i + 0.5) * 180 / 2 ** lat_bits - 90, (lon_i + 0.5) * 360 / 2 ** lon_bits - 180
+
+
+# (helper) Grid row/column of each point, for cells lat_step x lon_step degrees
+def grid_cells(lat, lon, lat_step, lon_step):
+    return (np.floor((lat + 90) / lat_step).astype(np.int64),
+            np.floor((np.asarray(lon) + 180) / lon_step).astype(np.int64))
+
+
+class SpatialIndex:
+    def __init__(self, rows: pd.DataFrame, cell_deg=CELL_DEG):
+        # rows without coordinates can't be placed, so they're left out
+        self.rows = rows[rows['latitude'].notna() & rows['longitude'].notna()]
+        if not self.rows.index.is_unique:
+            self.rows = self.rows.reset_index(drop=True)
+        self.lat = self.rows['latitude'].to_numpy(dtype=float)
+        self.lon = self.rows['longitude'].to_numpy(dtype=float)
+        if len(self.lat) and (np.abs(self.lat).max() > 90 or np.abs(self.lon).max() > 180):
+            raise ValueError("latitudes must be within ±90 and longitudes within ±180 (swapped columns?)")
+        self.cell_deg = cell_deg
+        self.num_cols = int(np.ceil(360 / cell_deg)) + 1
+        row, col = grid_cells(self.lat, self.lon, cell_deg, cell_deg)
+        codes = row * self.num_cols + col
+        # positions of the points in cell order, and the sorted cell codes to binary search
+        self.order = np.argsort(codes, kind='stable')
+        self.codes = codes[self.order]
+        self.tree = None
+
+    def __len__(self):
+        return len(self.lat)
+
+    # (helper) positions of the points inside a box (west <= east, no wrapping), by the cells it covers
+    def box_positions(self, south, west, north, east) -> np.ndarray:
+        (row_lo, row_hi), (col_lo, col_hi) = grid_cells(np.array([south, north]), np.array([west, east]),
+                                                        self.cell_deg, self.cell_deg)
+        rows = np.arange(row_lo, row_hi + 1, dtype=np.int64) * self.num_cols
+        starts = np.searchsorted(self.codes, rows + col_lo, side='left')
+        ends = np.searchsorted(self.codes, rows + col_hi, side='right')
+        positions = self.order[ranges(starts, ends)]
+        lat, lon = self.lat[positions], self.lon[positions]
+        return positions[(lat >= south) & (lat <= north) & (lon >= west) & (lon <= east)]
+
+    # (helper) positions of the points within km of a point, with their distances, nearest first
+    def radius_positions(self, lat, lon, km):
+        if self.tree is None:
+            self.tree = haversine_tree(self.lat, self.lon)
+        if self.tree is not False:
+            positions, distances = self.tree.query_radius(np.radians([[lat, lon]]), r=km / EARTH_RADIUS_KM,
+                                                          return_distance=True, sort_results=True)
+            return positions[0], distances[0] * EARTH_RADIUS_KM
+        # the box around the circle, then the exact distances
+        dlat = km / KM_PER_DEGREE
+        south, north = max(lat - dlat, -90), min(lat + dlat, 90)
+        widest = max(abs(south), abs(north))
+        dlon = 180 if widest >= 90 else min(dlat / np.cos(np.radians(widest)), 180)
+        positions = self.bbox_positions(south, lon - dlon, north, lon + dlon)
+        distances = haversine(lat, lon, self.lat[positions], self.lon[positions])
+        nearest = np.argsort(distances, kind='stable')
+        keep = nearest[distances[nearest] <= km]
+        return positions[keep], distances[keep]
+
+    # (helper) bbox_positions with longitudes outside ±180 wrapped, and boxes crossing the antimeridian
+    # (west > east) split in two
+    def bbox_positions(self, south, west, north, east) -> np.ndarray:
+        if east - west >= 360:
+            west, east = -180, 180
+        else:
+            west, east = (west + 180) % 360 - 180, (east + 180) % 360 - 180
+        if west <= east:
+            return self.box_positions(south, west, north, east)
+        return np.concatenate([self.box_positions(south, west, north, 180), self.box_positions(south, -180, north, east)])
+
+    # Rows inside a bounding box; west > east means the box crosses the antimeridian
+    def bbox(self, south, west, north, east) -> pd.DataFrame:
+        return self.rows.iloc[np.sort(self.bbox_positions(south, west, north, east))]
+
+    # Rows within km of a point, nearest first, with their distance_km
+    def radius(self, lat, lon, km) -> pd.DataFrame:
+        positions, distances = self.radius_positions(lat, lon, km)
+        return self.rows.iloc[positions].assign(distance_km=distances)
+
+    # (helper) positions of a subset of rows (all if None)
+    def positions(self, within=None) -> np.ndarray:
+        if within is None:
+            return np.arange(len(self))
+        positions = self.rows.index.get_indexer(within.index)
+        if (positions < 0).any():
+            raise KeyError("`within` has rows that aren't in this index")
+        return positions
+
+    # DBSCAN with haversine distances: a point with at least min_samples points (itself included) within eps_km
+    # is a core point, core points within eps_km of each other share a cluster, and other points join the cluster
+    # of a core point in reach, or are noise (-1). With `by`, each group (e.g. each identifier) is clustered
+    # separately, all in one pass; cluster numbers are unique across groups. `within` limits it to some rows,
+    # e.g. a region from bbox(). Returns each row's cluster, indexed like the rows.
+    #
+    # Points go into cells small enough that any two points in the same or adjacent cells are within eps_km, so
+    # crowded cells are core and linked to their neighbours without comparing points; exact distances are only
+    # needed for the few points and cell pairs the cells don't settle.
+    def cluster(self, eps_km, min_samples=4, by=None, within=None) -> pd.Series:
+        positions = self.positions(within)
+        groups = np.zeros(len(positions), dtype=np.int64) if by is None else \
+            pd.factorize(self.rows[by].to_numpy()[positions])[0]
+        # points at the same place (in the same group) are clustered once, weighted by how many there are
+        places = pd.DataFrame(dict(group=groups, lat=self.lat[positions], lon=self.lon[positions]))
+        place_of = places.groupby(['group', 'lat', 'lon'], sort=False).ngroup().to_numpy()
+        weights = np.bincount(place_of)
+        first_of = np.unique(place_of, return_index=True)[1]
+        groups, lat, lon = groups[first_of], places['lat'].to_numpy()[first_of], places['lon'].to_numpy()[first_of]
+        n = len(weights)
+        if n == 0:
+            return pd.Series(np.zeros(0, dtype=np.int64), index=self.rows.index[positions], name='cluster')
+
+        # cell sides at most eps_km / 2√2 (at the latitude where a degree of longitude is longest), in a whole
+        # number of columns around the globe so cells continue across the antimeridian
+        lat_step = eps_km / (2 * np.sqrt(2)) * 0.999 / KM_PER_DEGREE
+        nearest, widest = min(np.abs(lat).min(), 89.9), min(np.abs(lat).max(), 89.9)
+        num_lon = int(np.ceil(360 * np.cos(np.radians(nearest)) / lat_step))
+        lon_step = 360 / num_lon
+        row, col = grid_cells(lat, lon, lat_step, lon_step)
+        col %= num_lon
+        # how many cells away a point within eps_km can be
+        reach_rows = int(eps_km / KM_PER_DEGREE // lat_step) + 1
+        reach_cols = int(eps_km / KM_PER_DEGREE / np.cos(np.radians(widest)) // lon_step) + 2
+        num_rows = int(np.ceil(180 / lat_step)) + 2 * reach_rows + 1
+        adjacent = {(drow, dcol % num_lon) for drow in (-1, 0, 1) for dcol in (-1, 0, 1)}
+        around = sorted({(drow, dcol % num_lon) for drow in range(-reach_rows, reach_rows + 1)
+                         for dcol in range(-reach_cols, reach_cols + 1)} - adjacent)
+
+        # groups are part of the cell key, so points only neighbour points of their own group
+        codes = (groups * num_rows + row + reach_rows) * num_lon + col
+        by_cell = np.argsort(codes, kind='stable')
+        cells, firsts_in_cell, cell_of = np.unique(codes, return_index=True, return_inverse=True)
+        cell_group, cell_row, cell_col = groups[firsts_in_cell], row[firsts_in_cell], col[firsts_in_cell]
+
+        # (helper) for each of the given cells, the cell at an offset from it, or -1 where that's empty
+        def cells_at(of, drow, dcol):
+            target = (cell_group[of] * num_rows + cell_row[of] + drow + reach_rows) * num_lon + (cell_col[of] + dcol) % num_lon
+            i = np.minimum(np.searchsorted(cells, target), len(cells) - 1)
+            return np.where(cells[i] == target, i, -1)
+
+        # (helper) pairs of points and targets (both sorted by cell) within eps_km, with the targets in the cell
+        # at one of the offsets from each point's cell, a chunk of about PAIR_BUDGET candidates at a time. With
+        # `labels`, cells already given the same label aren't compared.
+        def pairs(points, targets, offsets, labels=None):
+            # the targets' range is the same for every point in a cell, so it's looked up once per cell
+            point_cells, first_point, cell_points = np.unique(cell_of[points], return_index=True, return_counts=True)
+            target_codes = codes[targets]
+            for drow, dcol in offsets:
+                target = cells_at(point_cells, drow, dcol)
+                found = target >= 0
+                if labels is not None:
+                    found[found] = labels[target[found]] != labels[point_cells[found]]
+                counts = cell_points[found]
+                starts = np.repeat(np.searchsorted(target_codes, cells[target[found]], side='left'), counts)
+                ends = np.repeat(np.searchsorted(target_codes, cells[target[found]], side='right'), counts)
+                near = points[ranges(first_point[found], first_point[found] + counts)]
+                candidates = np.cumsum(ends - starts)
+                cuts = np.searchsorted(candidates, np.arange(PAIR_BUDGET, candidates[-1] if len(near) else 0, PAIR_BUDGET))
+                for lo, hi in zip(np.concatenate([[0], cuts]), np.concatenate([cuts, [len(near)]])):
+                    first = np.repeat(near[lo:hi], ends[lo:hi] - starts[lo:hi])
+                    second = targets[ranges(starts[lo:hi], ends[lo:hi])]
+                    close = haversine(lat[first], lon[first], lat[second], lon[second]) <= eps_km
+                    yield first[close], second[close]
+
+        # core points: everything in the cell and the adjacent ones is in reach, then exact distances further out
+        # for points that need them
+        everywhere = np.arange(len(cells))
+        cell_weights = np.bincount(cell_of, weights=weights)
+        cell_reach = np.zeros(len(cells))
+        for drow, dcol in adjacent:
+            i = cells_at(everywhere, drow, dcol)
+            cell_reach += np.where(i >= 0, cell_weights[i], 0)
+        in_reach = cell_reach[cell_of]
+        for first, second in pairs(by_cell[in_reach[by_cell] < min_samples], by_cell, around):
+            in_reach += np.bincount(first, weights=weights[second], minlength=n)
+        core = in_reach >= min_samples
+        core_points = by_cell[core[by_cell]]
+
+        # clusters: cells holding core points are linked to the adjacent ones, then to cells further out (of
+        # other clusters so far) that hold a core point within eps_km
+        core_cell = np.bincount(cell_of[core_points], minlength=len(cells)) > 0
+        core_cells = np.flatnonzero(core_cell)
+        links = []
+        for drow, dcol in adjacent:
+            i = cells_at(core_cells, drow, dcol)
+            linked = i >= 0
+            linked[linked] = core_cell[i[linked]]
+            links.append((core_cells[linked], i[linked]))
+        labels = connected_components(len(cells), *map(np.concatenate, zip(*links)))
+        for first, second in pairs(core_points, core_points, around, labels):
+            links.append((cell_of[first], cell_of[second]))
+        labels = connected_components(len(cells), *map(np.concatenate, zip(*links)))
+        cluster = np.where(core, labels[cell_of], -1)
+
+        # border points join the (lowest-numbered) cluster of a core point they reach
+        cell_reached = np.full(len(cells), len(cells))
+        for drow, dcol in adjacent:
+            i = cells_at(everywhere, drow, dcol)
+            near = i >= 0
+            near[near] = core_cell[i[near]]
+            cell_reached[near] = np.minimum(cell_reached[near], labels[i[near]])
+        reached = cell_reached[cell_of]
+        for first, second in pairs(by_cell[~core[by_cell] & (reached[by_cell] == len(cells))], core_points, around):
+            np.minimum.at(reached, first, labels[cell_of[second]])
+        cluster[~core & (reached < len(cells))] = reached[~core & (reached < len(cells))]
+
+        # back to rows, with the clusters numbered 0, 1, ... in order of the rows
+        cluster = cluster[place_of]
+        clustered = cluster >= 0
+        cluster[clustered] = pd.factorize(cluster[clustered])[0]
+        return pd.Series(cluster, index=self.rows.index[positions], name='cluster')
+
+    # IDs per geohash cell (and per value of `by`), with each cell's centre, most IDs first. `within` limits it
+    # to some rows, e.g. a region from bbox() or radius().
+    def heatmap(self, precision=4, by=None, within=None) -> pd.DataFrame:
+        positions = self.positions(within)
+        codes = geohash_codes(self.lat[positions], self.lon[positions], precision)
+        if by is None:
+            cells, counts = np.unique(codes, return_counts=True)
+            table = pd.DataFrame(dict(ids=counts))
+        else:
+            values, uniques = pd.factorize(self.rows[by].to_numpy()[positions])
+            keys, counts = np.unique(codes * len(uniques) + values, return_counts=True)
+            cells = keys // len(uniques)
+            table = pd.DataFrame({by: uniques[keys % len(uniques)], 'ids': counts})
+        lat, lon = geohash_centres(cells, precision)
+        table.insert(0, 'geohash', geohash(lat, lon, precision))
+        table.insert(1, 'latitude', lat)
+        table.insert(2, 'longitude', lon)
+        return table.sort_values('ids', ascending=False, kind='stable', ignore_index=True)
+
+
+# (helper) sklearn's haversine BallTree over the points, or False without scikit-learn
+def haversine_tree(lat, lon):
+    try:
+        from sklearn.neighbors import BallTree
+    except ImportError:
+        return False
+    return BallTree(np.radians(np.column_stack([lat, lon])), metric='haversine')
+
+
+# (helper) Component number of each of n nodes, given the edges between them (the lowest node in each component)
+def connected_components(n, first, second) -> np.ndarray:
+    labels = np.arange(n)
+    while True:
+        # every node takes the lowest label among its neighbours, then labels are followed to their roots
+        lowest = labels.copy()
+        np.minimum.at(lowest, labels[first], labels[second])
+        np.minimum.at(lowest, labels[second], labels[first])
+        while True:
+            jumped = lowest[lowest]
+            if np.array_equal(jumped, lowest):
+                break
+            lowest = jumped
+        if np.array_equal(lowest, labels):
+            return labels
+        labels = lowest
@@ -0,0 +1,244 @@
+from bisect import bisect
+import csv
+from datetime import datetime, timedelta, timezone
+from itertools import accumulate
+from os import makedirs
+from os.path import basename, dirname, join
+import random
+
+from jsonstream import JsonArrayWriter
+
+# Deterministic generator of raw observations in the shape the iNaturalist v1 API returns them (and prune_obs()
+# expects): full user and taxon objects, identifications with previous_observation_taxon, withdrawn and revised IDs,
+# comments, flags, votes, annotations, ofvs and quality metrics. Taxa come from the real taxonomy in
+# coccinellidae.csv, weighted by their worldwide observation counts; identifier and observer activity follow power
+# laws, so a few identifiers make most of the IDs, as in stats.csv.
+#
+# Observation i depends only on (seed, i), so any slice can be generated on its own:
+#   SyntheticObs(1_000_000)[:10]
+#   write_raw_folder('obs_synth', SyntheticObs(100_000))   same layout as import_obs() output
+
+TAXA_CSV = join(dirname(__file__), 'coccinellidae.csv')   # the checked-in copy, wherever this is run from
+START = datetime(2012, 1, 1, tzinfo=timezone.utc)
+END = datetime(2022, 3, 31, tzinfo=timezone.utc)
+OBS_PER_FILE = 20_000          # as import_obs() writes them: PAGES_PER_FILE pages of OBS_PER_PAGE
+TIME_ZONES = [timezone(timedelta(hours=h)) for h in (-8, -7, -6, -5, -4, 0)]
+# identifications beyond the observer's own: 0-5, about 1.4 on average
+EXTRA_IDS = list(accumulate([0.15, 0.45, 0.25, 0.09, 0.04, 0.02]))
+
+
+class SyntheticObs:
+    def __init__(self, num_obs, seed=0, taxa_csv=TAXA_CSV, num_identifiers=None, num_observers=None):
+        self.num_obs = num_obs
+        self.seed = seed
+        # Population sizes grow sublinearly with the number of observations; ~11,700 identifiers at 300k observations
+        self.num_identifiers = num_identifiers or max(50, int(11_700 * (num_obs / 300_000) ** 0.7))
+        self.num_observers = num_observers or max(50, num_obs // 6)
+        # Zipf weights: the k-th most active user does about 1/k as much as the most active
+        self.identifier_weights = list(accumulate(1 / k ** 1.05 for k in range(1, self.num_identifiers + 1)))
+        self.observer_weights = list(accumulate(1 / k for k in range(1, self.num_observers + 1)))
+
+        with open(taxa_csv, newline='') as f:
+            rows = list(csv.DictReader(f))
+        self.taxa = {int(row['id']): row for row in rows}
+        self.parent = {int(row['id']): int(row['parent']) for row in rows}
+        self.children = {}
+        for taxon_id, parent in self.parent.items():
+            self.children.setdefault(parent, []).append(taxon_id)
+        # observed taxa: anything within the family, weighted by the observations identified to exactly that taxon
+        # (its worldwide count less its children's), so common species come up most
+        counts = {t: int(row['obs_worldwide'] or 0) for t, row in self.taxa.items()}
+        self.observable = [t for t, row in self.taxa.items() if float(row['level']) <= 30]
+        self.taxon_weights = list(accumulate(
+            max(counts[t] - sum(counts[child] for child in self.children.get(t, [])), 0) + 1 for t in self.observable))
+        self.raw_taxa = {}
+        self.raw_users = {}
+
+    def __len__(self):
+        return self.num_obs
+
+    def __iter__(self):
+        return (self.observation(i) for i in range(self.num_obs))
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.observation(k) for k in range(*i.indices(self.num_obs))]
+        return self.observation(i)
+
+    # (helper) root-first taxon IDs from the top of the table down to taxon_id
+    def ancestor_ids(self, taxon_id) -> list:
+        chain = [taxon_id]
+        while self.parent.get(chain[-1], 0) and len(chain) < 30:
+            chain.append(self.parent[chain[-1]])
+        return chain[::-1]
+
+    def taxon(self, taxon_id) -> dict:
+        if taxon_id not in self.raw_taxa:
+            row = self.taxa[taxon_id]
+            ancestors = self.ancestor_ids(taxon_id)
+            level = float(row['level'])
+            self.raw_taxa[taxon_id] = dict(
+                id=taxon_id, rank=row['rank'], rank_level=int(level) if level.is_integer() else level,
+                iconic_taxon_id=47158, ancestor_ids=ancestors, is_active=True, name=row['name'],
+                parent_id=self.parent[taxon_id] or None, ancestry='/'.join(map(str, ancestors[:-1])), extinct=False,
+                default_photo=dict(id=taxon_id * 3, license_code='cc-by-nc', attribution='(c) someone, some rights reserved (CC BY-NC)',
+                                   url=f"https://static.inaturalist.org/photos/{taxon_id * 3}/square.jpg",
+                                   original_dimensions=dict(height=1536, width=2048), flags=[]),
+                taxon_changes_count=0, taxon_schemes_count=1, observations_count=int(row['obs_worldwide'] or 0),
+                flag_counts=dict(resolved=0, unresolved=0), current_synonymous_taxon_ids=None, atlas_id=None,
+                complete_species_count=None, wikipedia_url=None, iconic_taxon_name='Insecta',
+                preferred_common_name=row['common'], created_at='2012-02-15T07:44:23+00:00', endemic=False,
+                threatened=False, native=True, introduced=False)
+        return dict(self.raw_taxa[taxon_id])
+
+    def user(self, user_id) -> dict:
+        if user_id not in self.raw_users:
+            rng = random.Random(user_id)
+            self.raw_users[user_id] = dict(
+                id=user_id, login=f"user{user_id}", spam=False, suspended=False,
+                created_at=(START + timedelta(days=rng.randint(0, 3000))).isoformat(), login_autocomplete=f"user{user_id}",
+                login_exact=f"user{user_id}", name=f"User {user_id}" if rng.random() < 0.5 else None,
+                name_autocomplete=None, orcid=None, icon=None, observations_count=rng.randint(1, 5000),
+                identifications_count=rng.randint(0, 50_000), journal_posts_count=rng.randint(0, 3),
+                activity_count=rng.randint(1, 60_000), species_count=rng.randint(1, 2000), universal_search_rank=1,
+                roles=['curator'] if rng.random() < 0.02 else [], site_id=1, icon_url=None)
+        return dict(self.raw_users[user_id])
+
+    # Raw taxon objects for every taxon in the table (e.g. for mock_server.py's taxa endpoints)
+    def all_taxa(self) -> list:
+        return [self.taxon(taxon_id) for taxon_id in self.taxa]
+
+    # (helper) user IDs: identifiers and observers are numbered by activity rank, in overlapping ID ranges
+    def pick_identifier(self, rng) -> int:
+        return 1000 + 7 * bisect(self.identifier_weights, rng.random() * self.identifier_weights[-1])
+
+    def pick_observer(self, rng) -> int:
+        return 1000 + 3 * bisect(self.observer_weights, rng.random() * self.observer_weights[-1])
+
+    # (helper) a taxon near `taxon_id`: itself, an ancestor within the family, or a sibling
+    def related_taxon(self, taxon_id, rng) -> int:
+        roll = rng.random()
+        parent = self.parent.get(taxon_id, 0)
+        if roll < 0.12 and parent in self.taxa and float(self.taxa[parent]['level']) <= 30:
+            return parent
+        if roll < 0.18 and len(self.children.get(parent, [])) > 1:
+            return rng.choice(self.children[parent])
+        return taxon_id
+
+    def observation(self, i) -> dict:
+        if not 0 <= i < self.num_obs:
+            raise IndexError(i)
+        rng = random.Random(self.seed * 1_000_003 + i)
+        obs_id = 1000 + 37 * i + rng.randrange(37)    # increasing with i, like the API's
+        observer = self.pick_observer(rng)
+        home = random.Random(observer)                 # observers stay near home
+        zone = home.choice(TIME_ZONES)
+        created = START + (END - START) * (i / self.num_obs) + timedelta(seconds=rng.randrange(3600))
+        observed = created - timedelta(days=int(rng.expovariate(1 / 20)))
+        true_taxon = self.observable[bisect(self.taxon_weights, rng.random() * self.taxon_weights[-1])]
+        lon = home.uniform(-124, -68) + rng.gauss(0, 0.3)
+        lat = home.uniform(26, 49) + rng.gauss(0, 0.3)
+
+        # The observer's own ID is often coarser than the truth; identifiers then confirm, refine or disagree
+        own_taxon = self.related_taxon(true_taxon, rng)
+        idents = [self.identification(obs_id * 10, created, observer, own_taxon, None, True, 'leading', rng)]
+        when = created
+        for k in range(bisect(EXTRA_IDS, rng.random() * EXTRA_IDS[-1])):
+            identifier = self.pick_identifier(rng)
+            if identifier == observer:
+                continue
+            when = when + timedelta(hours=rng.paretovariate(1.1))
+            previous = idents[-1]['taxon']['id']
+            taxon_id = self.related_taxon(true_taxon, rng)
+            disagreement = taxon_id not in self.ancestor_ids(previous) and previous not in self.ancestor_ids(taxon_id)
+            category = 'maverick' if disagreement and rng.random() < 0.3 else \
+                'improving' if taxon_id != previous and not disagreement else 'supporting'
+            idents.append(self.identification(obs_id * 10 + len(idents), when, identifier, taxon_id, previous,
+                                              disagreement, category, rng))
+            # an occasional change of mind: the earlier ID is withdrawn in favour of a new one
+            if rng.random() < 0.04:
+                idents[-1]['current'] = False
+                when = when + timedelta(days=rng.randint(1, 400))
+                idents.append(self.identification(obs_id * 10 + len(idents), when, identifier, true_taxon, taxon_id,
+                                                  False, 'improving', rng))
+        current = [ident for ident in idents if ident['current']]
+        obs_taxon = current[-1]['taxon']['id']
+        agreeing = sum(ident['taxon']['id'] == obs_taxon for ident in current)
+        updated = max(when, created)
+
+        comments = [dict(id=obs_id * 3 + k, uuid=f"c-{obs_id}-{k}", user=self.user(self.pick_identifier(rng)),
+                         body="Nice find!", created_at=(created + timedelta(hours=rng.randint(1, 900))).isoformat(),
+                         created_at_details={}, hidden=False, flags=[], moderator_actions=[])
+                    for k in range(rng.choices([0, 1, 2], [0.88, 0.09, 0.03])[0])]
+        flags = [dict(id=obs_id, flag='spam', resolved=True, user=self.user(self.pick_identifier(rng)),
+                      created_at=(created + timedelta(days=1)).isoformat())] if rng.random() < 0.005 else []
+        # votes come back without a time zone, as some do from the real API
+        votes = [dict(id=obs_id * 5, vote_flag=True, vote_scope='needs_id', user_id=(voter := self.pick_identifier(rng)),
+                      user=self.user(voter), created_at=(created + timedelta(days=2)).strftime('%Y-%m-%dT%H:%M:%S'))] \
+            if rng.random() < 0.05 else []
+        annotations = [dict(uuid=f"a-{obs_id}", controlled_attribute_id=1, controlled_value_id=rng.choice([2, 3, 4]),
+                            user_id=observer, user=self.user(observer), vote_score=0, votes=[],
+                            concatenated_attr_val='1|2')] if rng.random() < 0.3 else []
+        ofvs = []
+        if rng.random() < 0.15:
+            prey = self.observable[rng.randrange(len(self.observable))]
+            ofvs.append(dict(id=obs_id * 7, uuid=f"o-{obs_id}", field_id=47, datatype='taxon', name='Eating',
+                             name_ci='Eating', value=str(prey), value_ci=str(prey), user_id=observer, taxon=self.taxon(prey)))
+        quality_metrics = [dict(id=obs_id, user_id=observer, user=self.user(observer), metric='wild', agree=True)] \
+            if rng.random() < 0.03 else []
+
+        return dict(
+            id=obs_id, uuid=f"obs-{obs_id}", quality_grade='research' if agreeing >= 2 and len(current) else 'needs_id',
+            time_observed_at=observed.astimezone(zone).isoformat(), taxon_geoprivacy=None, annotations=annotations,
+            cached_votes_total=len(votes), identifications_most_agree=agreeing * 3 > len(current) * 2, species_guess=self.taxa[own_taxon]['name'],
+            identifications_most_disagree=False, tags=[], positional_accuracy=rng.choice([5, 10, 30, 100, 500, None]),
+            comments_count=len(comments), site_id=1, created_time_zone='America/Chicago', license_code='cc-by-nc',
+            observed_time_zone='America/Chicago', quality_metrics=quality_metrics, public_positional_accuracy=30,
+            reviewed_by=[ident['user']['id'] for ident in idents], oauth_application_id=None, flags=flags,
+            created_at=created.astimezone(zone).isoformat(), description=None, time_zone_offset='-06:00',
+            project_ids_with_curator_id=[], observed_on=observed.date().isoformat(), observed_on_string=str(observed),
+            updated_at=updated.astimezone(zone).isoformat(), sounds=[], place_ids=[97394, 1, 1 + int(lon) % 50, 1000 + int(lat * 10)],
+            captive=False, taxon=self.taxon(obs_taxon), ident_taxon_ids=sorted({t for ident in idents for t in ident['taxon']['ancestor_ids']}),
+            outlinks=[], faves_count=0, ofvs=ofvs, num_identification_agreements=agreeing - 1 if agreeing else 0,
+            preferences=dict(prefers_community_taxon=None), comments=comments, map_scale=None, uri=f"https://www.inaturalist.org/observations/{obs_id}",
+            project_ids=[], community_taxon_id=obs_taxon if agreeing >= 2 else None, geojson=dict(type='Point', coordinates=[lon, lat]),
+            owners_identification_from_vision=False, identifications_count=len(idents) - 1, obscured=False,
+            num_identification_disagreements=sum(ident['disagreement'] or False for ident in idents), geoprivacy=None,
+            location=f"{lat},{lon}", votes=votes, spam=False, user=self.user(observer), mappable=True,
+            identifications_some_agree=agreeing >= 2, project_ids_without_curator_id=[], place_guess='Somewhere, USA',
+            identifications=idents, project_observations=[], photos=[dict(id=obs_id * 4 + k, license_code='cc-by-nc',
+            url=f"https://static.inaturalist.org/photos/{obs_id * 4 + k}/square.jpg", attribution='(c) someone',
+            original_dimensions=dict(height=1536, width=2048), flags=[]) for k in range(rng.randint(1, 4))],
+            observation_photos=[], faves=[], non_owner_ids=[], observed_on_details=dict(date=observed.date().isoformat()),
+            created_at_details=dict(date=created.date().isoformat()), id_please=False)
+
+    # (helper) one raw identification
+    def identification(self, ident_id, when, user_id, taxon_id, previous, disagreement, category, rng) -> dict:
+        created = when.isoformat() if rng.random() > 0.01 else when.strftime('%Y-%m-%dT%H:%M:%S')
+        ident = dict(id=ident_id, uuid=f"i-{ident_id}", own_observation=previous is None, created_at=created,
+                     created_at_details=dict(date=when.date().isoformat()), user=self.user(user_id),
+                     taxon=self.taxon(taxon_id), current=True, disagreement=disagreement if previous else None,
+                     category=category, vision=rng.random() < 0.35, hidden=rng.random() < 0.002,
+                     previous_observation_taxon_id=previous, body=None, flags=[], moderator_actions=[],
+                     spam=False, taxon_change=None)
+        if previous:
+            ident['previous_observation_taxon'] = self.taxon(previous)
+        return ident
+
+
+# Writes observations as import_obs() does: '<folder>/<folder>_1.json', '<folder>/<folder>_2.json', ... with
+# OBS_PER_FILE each. Returns the file names.
+def write_raw_folder(folder, observations, per_file=OBS_PER_FILE) -> list:
+    makedirs(folder, exist_ok=True)
+    fnames = []
+    writer = None
+    for n, obs in enumerate(observations):
+        if n % per_file == 0:
+            if writer:
+                writer.close()
+            fnames.append(f"{folder}/{basename(folder)}_{len(fnames) + 1}.json")
+            writer = JsonArrayWriter(fnames[-1])
+        writer.write(obs)
+    if writer:
+        writer.close()
+    return fnames
@@ -0,0 +1,144 @@
+import csv
+import json
+
+import numpy as np
+
+# Taxonomy index for batch "how far apart are these two taxa?" queries, e.g. every identification vs. its
+# observation's community taxon. The tree is held as flat integer arrays (parent, depth) over dense node numbers,
+# and lowest common ancestors come from an Euler tour plus a sparse table of range minimums, so each query is a
+# handful of array lookups no matter how deep the tree is.
+#
+#   TAXONOMY = TaxonomyIndex.from_taxa_json('observations/taxa.json')
+#   TAXONOMY.distance(ids['taxon_id'], ids['community_taxon_id'])
+
+
+class TaxonomyIndex:
+    # parents: {taxon ID: parent taxon ID (0 or None for a root)}; rank_levels/ranks: {taxon ID: value}, may be partial.
+    # Taxa whose chain doesn't reach a common root hang off a virtual root, which lca() reports as 0.
+    def __init__(self, parents: dict, rank_levels=None, ranks=None):
+        rank_levels = rank_levels or {}
+        ranks = ranks or {}
+        taxon_ids = set(parents) | {p for p in parents.values() if p}
+        # node 0 is the virtual root; real taxa are numbered in ID order, so lookups are a binary search
+        self.ids = np.array([0] + sorted(taxon_ids), dtype=np.int64)
+        self.parent = np.zeros(len(self.ids), dtype=np.int32)
+        children = np.array([t for t, p in parents.items() if p], dtype=np.int64)
+        self.parent[self.index(children)] = self.index([parents[t] for t in children])
+        self.parent[0] = -1
+        self.rank_level = np.array([np.nan] + [rank_levels.get(t, np.nan) for t in self.ids[1:]], dtype=np.float32)
+        self.rank = np.array([''] + [ranks.get(t, '') for t in self.ids[1:]], dtype=object)
+        self._build_euler_tour()
+
+    @classmethod
+    def from_taxa_json(cls, fname='observations/taxa.json'):
+        with open(fname) as f:
+            taxa = json.load(f)
+        parents = {}
+        for taxon in taxa.values():
+            # ancestor_ids run from the root down to the taxon itself, so they give parent links for every ancestor too
+            chain = taxon['ancestor_ids']
+            parents.setdefault(chain[0], 0)
+            for parent_id, taxon_id in zip(chain, chain[1:]):
+                parents[taxon_id] = parent_id
+        return cls(parents, rank_levels={t['id']: t['rank_level'] for t in taxa.values()},
+                   ranks={t['id']: t['rank'] for t in taxa.values()})
+
+    @classmethod
+    def from_csv(cls, fname='coccinellidae.csv'):
+        with open(fname, newline='') as f:
+            rows = list(csv.DictReader(f))
+        return cls({int(row['id']): int(row['parent']) for row in rows},
+                   rank_levels={int(row['id']): float(row['level']) for row in rows},
+                   ranks={int(row['id']): row['rank'] for row in rows})
+
+    # (helper) dense node numbers for an array of taxon IDs; -1 for taxa not in the index
+    def index(self, taxon_ids):
+        taxon_ids = np.atleast_1d(np.asarray(taxon_ids, dtype=np.int64))
+        pos = np.searchsorted(self.ids, taxon_ids).clip(max=len(self.ids) - 1)
+        return np.where(self.ids[pos] == taxon_ids, pos, -1)
+
+    def _build_euler_tour(self) -> None:
+        n = len(self.ids)
+        # children as CSR arrays
+        order = np.argsort(self.parent[1:], kind='stable') + 1
+        child_start = np.searchsorted(self.parent[order], np.arange(n + 1))
+
+        self.depth = np.zeros(n, dtype=np.int32)
+        euler = np.empty(2 * n - 1, dtype=np.int32)
+        self.first = np.zeros(n, dtype=np.int64)
+        # iterative DFS: each stack entry is (node, next child position)
+        stack = [(0, child_start[0])]
+        pos = 0
+        euler[pos] = 0
+        self.first[0] = 0
+        while stack:
+            node, child = stack[-1]
+            if child < child_start[node + 1]:
+                stack[-1] = (node, child + 1)
+                nxt = order[child]
+                self.depth[nxt] = self.depth[node] + 1
+                pos += 1
+                euler[pos] = nxt
+                self.first[nxt] = pos
+                stack.append((nxt, child_start[nxt]))
+            else:
+                stack.pop()
+                if stack:
+                    pos += 1
+                    euler[pos] = stack[-1][0]
+
+        # sparse[k][i] = shallowest node in euler[i : i + 2**k]
+        self.sparse = [euler]
+        k = 1
+        while 2 ** k <= len(euler):
+            prev = self.sparse[-1]
+            half = 2 ** (k - 1)
+            left, right = prev[:-half], prev[half:]
+            self.sparse.append(np.where(self.depth[left] <= self.depth[right], left, right))
+            k += 1
+
+    # Lowest common ancestors of taxon ID pairs (0 if only the virtual root is shared, -1 if either taxon is unknown)
+    def lca(self, a, b):
+        return self.ids_of(self._lca(self.index(a), self.index(b)))
+
+    def _lca(self, a, b):
+        known = (a >= 0) & (b >= 0)
+        lo = np.minimum(self.first[a], self.first[b])
+        hi = np.maximum(self.first[a], self.first[b])
+        k = np.floor(np.log2(hi - lo + 1)).astype(np.int64)
+        result = np.full(len(a), -1, dtype=np.int64)
+        for level in np.unique(k[known]):
+            rows = known & (k == level)
+            table = self.sparse[level]
+            left, right = table[lo[rows]], table[hi[rows] - 2 ** level + 1]
+            result[rows] = np.where(self.depth[left] <= self.depth[right], left, right)
+        return result
+
+    # (helper) node numbers back to taxon IDs, keeping -1 for unknowns
+    def ids_of(self, nodes):
+        return np.where(nodes >= 0, self.ids[nodes], -1)
+
+    # One taxon's lineage as taxon IDs, from the taxon itself up to its top-most ancestor ([] if it's unknown)
+    def ancestors(self, taxon_id) -> list:
+        node = self.index(taxon_id)[0]
+        lineage = []
+        while node > 0:
+            lineage.append(int(self.ids[node]))
+            node = self.parent[node]
+        return lineage
+
+    # Number of tree edges between each pair of taxa (-1 if either taxon is unknown)
+    def distance(self, a, b):
+        a, b = self.index(a), self.index(b)
+        common = self._lca(a, b)
+        dist = self.depth[a] + self.depth[b] - 2 * self.depth[common]
+        return np.where(common >= 0, dist, -1)
+
+    # Rank level / rank name of each pair's lowest common ancestor (NaN / '' when unknown)
+    def lca_rank_level(self, a, b):
+        common = self._lca(self.index(a), self.index(b))
+        return np.where(common >= 0, self.rank_level[common], np.nan)
+
+    def lca_rank(self, a, b):
+        common = self._lca(self.index(a), self.index(b))
+        return np.where(common >= 0, self.rank[common], '')